@@ -0,0 +1,77 @@
+"""
+Time of splitting many expenses at once with a growing number in flight, against a
+stub that rejects some of the balancing transfers, and a check that no expense is
+left half split.
+
+    python bench/batch_split.py [--transactions N] [--latency MS] [--fail-every N]
+
+Every `--fail-every`th transfer is answered with a 500. Its expense must then still
+have its original amount, and every split expense must have its transfer.
+"""
+import argparse
+import sys
+import time
+from decimal import Decimal
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+from async_firefly import AsyncFirefly, run_coroutine  # noqa: E402
+from firefly import SPLIT_BALANCE_ACCOUNT, host_limiter  # noqa: E402
+from firefly_stub import Dataset, StubHandler, StubServer  # noqa: E402
+from models import Transaction  # noqa: E402
+
+
+class FlakyHandler(StubHandler):
+    def route(self, method, path, endpoint, query, payload, url):
+        if method == "POST" and payload["transactions"][0].get("type") == "transfer":
+            with self.server.lock:
+                self.server.transfers += 1
+                fail = self.server.transfers % self.server.fail_every == 0
+            if fail:
+                return 500, {"message": "Internal server error"}
+        return super().route(method, path, endpoint, query, payload, url)
+
+
+def check(dataset, original):
+    """Expenses that were reduced without a transfer, or that got a transfer but kept their amount"""
+    transfers = {split["description"] for tx in dataset.transactions.values()
+                 for split in tx["attributes"]["transactions"] if split["type"] == "transfer"
+                 and split.get("destination_name") == SPLIT_BALANCE_ACCOUNT}
+    broken = 0
+    for tx_id, amount in original.items():
+        split = dataset.transactions[tx_id]["attributes"]["transactions"][0]
+        reduced = Decimal(str(split["amount"])) != amount
+        if reduced != (split["description"] in transfers):
+            broken += 1
+    return broken
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--transactions", type=int, default=40)
+    parser.add_argument("--latency", type=float, default=30, help="added to every Firefly call, in ms")
+    parser.add_argument("--fail-every", type=int, default=5)
+    args = parser.parse_args()
+    # the per host rate limit would set the pace, not the number in flight
+    host_limiter.configure(None, 0)
+
+    print(f"{'concurrency':>11} {'time':>8} {'split':>6} {'failed':>7} {'half split':>11}")
+    for concurrency in (1, 4, 8):
+        dataset = Dataset(expense_accounts=10, rules=0, transactions=args.transactions)
+        with StubServer(latency=args.latency / 1000, dataset=dataset, handler=FlakyHandler) as server:
+            server.httpd.transfers = 0
+            server.httpd.fail_every = args.fail_every
+            firefly = AsyncFirefly(server.url, "bench-token")
+            transactions = [Transaction.from_json(tx) for tx in dataset.transactions.values()]
+            original = {tx.id: tx.split.amount for tx in transactions}
+            start = time.perf_counter()
+            results = run_coroutine(firefly.split_transactions(transactions, Decimal(2), concurrency=concurrency))
+            elapsed = time.perf_counter() - start
+            split = sum(1 for result in results if result.tx_id)
+            print(f"{concurrency:>11} {elapsed:7.2f}s {split:>6} {len(results) - split:>7} "
+                  f"{check(dataset, original):>11}")
+
+
+if __name__ == "__main__":
+    main()
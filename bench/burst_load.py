@@ -0,0 +1,105 @@
+"""
+Burst of concurrent users against a small Firefly instance, with and without request
+coalescing and the per host rate limit.
+
+    python bench/burst_load.py [--users N] [--requests N] [--capacity N] [--rate PER_SECOND]
+
+The stub answers 503 while more than `--capacity` requests are being served, like a
+small PHP-FPM pool would. Every user reads the asset accounts, the rules and one
+transaction of its own, at the same time.
+"""
+import argparse
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+import firefly  # noqa: E402
+from firefly_stub import Dataset, StubHandler, StubServer  # noqa: E402
+from throttle import SingleFlight  # noqa: E402
+
+
+class BusyHandler(StubHandler):
+    def _handle(self):
+        server = self.server
+        with server.lock:
+            server.active += 1
+            overloaded = server.active > server.capacity
+        try:
+            if overloaded:
+                with server.lock:
+                    server.rejected += 1
+                self._reply(503, {"message": "Service unavailable"})
+            else:
+                super()._handle()
+        finally:
+            with server.lock:
+                server.active -= 1
+
+    do_GET = _handle
+
+
+class NoCoalescing(object):
+    def do(self, key, fn):
+        return fn(), False
+
+
+def run(mode, server, users, requests, rate, burst):
+    if mode == "protected":
+        firefly._inflight = SingleFlight()
+        firefly.host_limiter.configure(rate, burst)
+    else:
+        firefly._inflight = NoCoalescing()
+        firefly.host_limiter.configure(None, 0)
+    server.httpd.rejected = 0
+    calls_before = server.calls
+    latencies = []
+    errors = []
+
+    def user(index):
+        client = firefly.Firefly(server.url, "bench-token")
+        for i in range(requests):
+            for call in (lambda: client.get_accounts("asset"), client.get_rules,
+                         lambda: client.get_transaction(1 + (index * requests + i) % 500)):
+                start = time.perf_counter()
+                try:
+                    call()
+                except Exception as e:
+                    errors.append(e)
+                latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=users) as executor:
+        list(executor.map(user, range(users)))
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    sent = sum((server.calls - calls_before).values())
+    print(f"{mode:<10} {elapsed:6.2f}s  sent {sent:5}  rejected {server.httpd.rejected:5}  errors {len(errors):4}  "
+          f"median {statistics.median(latencies) * 1000:7.1f} ms  p99 {latencies[int(len(latencies) * 0.99) - 1] * 1000:7.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=40)
+    parser.add_argument("--requests", type=int, default=5, help="rounds of requests per user")
+    parser.add_argument("--capacity", type=int, default=4, help="requests the stub serves at once")
+    parser.add_argument("--latency", type=float, default=20, help="stub latency per request, in ms")
+    parser.add_argument("--rate", type=float, default=100, help="rate limit per host, requests per second")
+    parser.add_argument("--burst", type=int, default=4)
+    args = parser.parse_args()
+
+    with StubServer(latency=args.latency / 1000, dataset=Dataset(), handler=BusyHandler) as server:
+        server.httpd.capacity = args.capacity
+        server.httpd.active = 0
+        server.httpd.rejected = 0
+        for mode in ("plain", "protected"):
+            run(mode, server, args.users, args.requests, args.rate, args.burst)
+            time.sleep(1)
+
+
+if __name__ == "__main__":
+    main()
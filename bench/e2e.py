@@ -0,0 +1,209 @@
+"""
+Drive synthetic Telegram updates through the conversations registered in `main()`
+against the local Firefly stub, and report per flow latency, Firefly calls and memory.
+
+    python bench/e2e.py [--runs N] [--latency MS] [--accounts N] [--rules N] [--transactions N]
+
+Nothing is sent to Telegram, replies are recorded by a fake request object and the
+buttons they carry are used to choose the next step of a flow.
+"""
+import argparse
+import json
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+import warnings
+from itertools import count
+from pathlib import Path
+from queue import Queue
+
+from telegram import Bot, Update
+from telegram.ext import Dispatcher
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+import bot  # noqa: E402
+from firefly_stub import Dataset, StubServer  # noqa: E402
+from mirror import TransactionMirror  # noqa: E402
+from outbox import Outbox, OutboxWorker  # noqa: E402
+
+USER = {"id": 4242, "is_bot": False, "first_name": "Bench"}
+CHAT = {"id": 4242, "type": "private"}
+
+
+class FakeRequest(object):
+    """Answers the Bot API calls locally and remembers the last inline keyboard sent"""
+
+    def __init__(self):
+        self.keyboard = []
+        self.messages = 0
+        self.ids = count(1)
+
+    def get(self, url, timeout=None):
+        if url.endswith("getMe"):
+            return {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        return []
+
+    def post(self, url, data, timeout=None):
+        if url.endswith(("answerCallbackQuery", "answerInlineQuery")):
+            return True
+        self.messages += 1
+        markup = data.get("reply_markup")
+        if markup:
+            markup = json.loads(markup) if isinstance(markup, str) else markup.to_dict()
+            self.keyboard = [button["callback_data"] for row in markup.get("inline_keyboard", [])
+                             for button in row if "callback_data" in button]
+        return {"message_id": next(self.ids), "date": int(time.time()), "chat": CHAT, "text": data.get("text", "")}
+
+    def stop(self):
+        pass
+
+
+class Driver(object):
+    def __init__(self, dispatcher, request):
+        self.dispatcher = dispatcher
+        self.request = request
+        self.update_ids = count(1)
+
+    def _message(self, text):
+        message = {"message_id": next(self.update_ids), "date": int(time.time()), "from": USER,
+                   "chat": CHAT, "text": text}
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return message
+
+    def send(self, text):
+        update = {"update_id": next(self.update_ids), "message": self._message(text)}
+        self.dispatcher.process_update(Update.de_json(update, self.dispatcher.bot))
+
+    def press(self, data=None):
+        """Press a button of the last inline keyboard, the first one unless `data` is given"""
+        if data is None:
+            data = self.request.keyboard[0]
+        update = {"update_id": next(self.update_ids), "callback_query": {
+            "id": str(next(self.update_ids)), "from": USER, "chat_instance": "bench", "data": data,
+            "message": self._message("keyboard")}}
+        self.dispatcher.process_update(Update.de_json(update, self.dispatcher.bot))
+
+    def inline(self, text):
+        update = {"update_id": next(self.update_ids), "inline_query": {
+            "id": str(next(self.update_ids)), "from": USER, "query": text, "offset": ""}}
+        self.dispatcher.process_update(Update.de_json(update, self.dispatcher.bot))
+
+
+def flow_start(driver, server):
+    driver.send("/start")
+    driver.send(server.url)
+    driver.send("bench-token")
+    driver.press()
+
+
+def flow_expense(driver, server):
+    driver.send("/expense")
+    driver.send("Something new")
+    driver.press()
+    driver.send("Shop 1")
+    driver.send("5")
+
+
+def flow_typeahead(driver, server):
+    for text in ("s", "sh", "sho", "shop", "shop 1", "shop 12", "shpo 12"):
+        driver.inline(text)
+
+
+def flow_quick(driver, server):
+    driver.send("5.20, Lunch, Category 3, Budget 2, Asset 2, Shop 7")
+
+
+def flow_balance(driver, server):
+    driver.send("/balance")
+    driver.press()
+
+
+def flow_balance_all(driver, server):
+    driver.send("/balance all")
+
+
+def flow_split(driver, server):
+    driver.send("/split")
+    driver.press()
+    driver.press("2")
+
+
+def flow_list(driver, server):
+    driver.send("/list")
+    driver.press("page:tx:8")
+    driver.press()
+    driver.press("cancel")
+
+
+def flow_split_many(driver, server):
+    driver.send("/splitmany")
+    driver.press()
+    driver.press(driver.request.keyboard[1])
+    driver.press("pick:done")
+    driver.press("2")
+
+
+def flow_report(driver, server):
+    driver.send("/report 2020-01 2020-12")
+    driver.send("/report")
+
+
+FLOWS = [flow_start, flow_expense, flow_typeahead, flow_quick, flow_balance, flow_balance_all, flow_split, flow_split_many,
+         flow_list, flow_report]
+
+
+def main():
+    warnings.filterwarnings("ignore", message="If 'per_message=False'")
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=5, help="added to every Firefly call, in ms")
+    parser.add_argument("--accounts", type=int, default=200)
+    parser.add_argument("--rules", type=int, default=200)
+    parser.add_argument("--transactions", type=int, default=500)
+    args = parser.parse_args()
+
+    dataset = Dataset(expense_accounts=args.accounts, rules=args.rules, transactions=args.transactions)
+    with StubServer(latency=args.latency / 1000, dataset=dataset) as server, tempfile.TemporaryDirectory() as tmp:
+        request = FakeRequest()
+        telegram = Bot("123456:bench", request=request)
+        dispatcher = Dispatcher(telegram, Queue(), use_context=True)
+        bot.add_handlers(dispatcher)
+        bot.outbox = Outbox(Path(tmp) / "outbox.sqlite")
+        bot.transaction_mirror = TransactionMirror(Path(tmp) / "transactions.sqlite")
+        # queued expenses are not delivered, the flow ends once the expense is stored locally
+        bot.outbox_worker = OutboxWorker(bot.outbox, notify=lambda chat_id, text: None)
+        dispatcher.user_data[USER["id"]].update(
+            firefly_url=server.url, firefly_token="bench-token", firefly_default_account="1",
+            firefly_split={"name": "Asset 2", "id": "2"})
+        driver = Driver(dispatcher, request)
+
+        print(f"{'flow':<12} {'mean':>9} {'p95':>9} {'calls':>7} {'messages':>9} {'peak memory':>12}")
+        for flow in FLOWS:
+            timings = []
+            calls_before, messages_before = server.calls, request.messages
+            for _ in range(args.runs):
+                start = time.perf_counter()
+                flow(driver, server)
+                timings.append((time.perf_counter() - start) * 1000)
+            calls = sum((server.calls - calls_before).values()) / args.runs
+            messages = (request.messages - messages_before) / args.runs
+
+            tracemalloc.start()
+            flow(driver, server)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+            timings.sort()
+            p95 = timings[max(0, int(len(timings) * 0.95) - 1)]
+            print(f"{flow.__name__[5:]:<12} {statistics.mean(timings):7.2f}ms {p95:7.2f}ms {calls:7.1f} "
+                  f"{messages:9.1f} {peak / 1024:9.0f} KiB")
+        bot.outbox.close()
+        bot.transaction_mirror.close()
+
+
+if __name__ == "__main__":
+    main()
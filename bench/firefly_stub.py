@@ -0,0 +1,209 @@
+"""
+An in-process stand-in for the parts of the Firefly III API the bot uses, for the
+benchmarks. It serves a synthetic dataset with Firefly's pagination, can add latency
+to every call and counts the calls per endpoint.
+"""
+import json
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+PAGE_SIZE = 50
+
+
+class Dataset(object):
+    def __init__(self, expense_accounts=200, rules=200, transactions=500, asset_accounts=5):
+        self.lock = threading.Lock()
+        self.accounts = {}
+        for i in range(1, asset_accounts + 1):
+            self._add_account(str(i), "asset", f"Asset {i}", account_role="defaultAsset")
+        for i in range(expense_accounts):
+            self._add_account(str(1000 + i), "expense", f"Shop {i}")
+        self.rules = [{
+            "type": "rules", "id": str(i + 1),
+            "attributes": {
+                "title": f"Shop {i}", "updated_at": "2020-11-01T00:00:00+00:00",
+                "triggers": [{"type": "description_contains", "value": f"shop {i}:"}],
+                "actions": [{"type": "set_source_account", "value": "Asset 1"},
+                            {"type": "set_destination_account", "value": f"Shop {i}"}],
+            }} for i in range(rules)]
+        self.transactions = {}
+        for i in range(1, transactions + 1):
+            self._add_transaction(str(i), {
+                "type": "withdrawal", "date": f"2020-{1 + i % 12:02d}-{1 + i % 28:02d}T00:00:00+00:00",
+                "amount": f"{i % 100 + 0.5:.2f}", "description": f"Purchase {i}",
+                "source_id": "1", "destination_id": str(1000 + i % max(expense_accounts, 1)),
+                "category_id": str(i % 10), "category_name": f"Category {i % 10}",
+                "budget_id": str(i % 5), "budget_name": f"Budget {i % 5}",
+            })
+        self.bills = [{"type": "bills", "id": str(i), "attributes": {"name": f"Bill {i}"}} for i in range(1, 11)]
+        self.budgets = [{"type": "budgets", "id": str(i), "attributes": {"name": f"Budget {i}"}} for i in range(5)]
+        self.categories = [{"type": "categories", "id": str(i), "attributes": {"name": f"Category {i}"}}
+                           for i in range(10)]
+        self.next_id = transactions + 1
+
+    def _add_account(self, account_id, account_type, name, account_role=None):
+        self.accounts[account_id] = {"type": "accounts", "id": account_id, "attributes": {
+            "name": name, "type": account_type, "active": True, "account_role": account_role,
+            "current_balance": "1000.00", "currency_code": "CHF", "currency_symbol": "CHF"}}
+
+    def _add_transaction(self, tx_id, split):
+        split = dict(split, currency_symbol="CHF", currency_code="CHF", currency_decimal_places=2)
+        for side in ("source", "destination"):
+            account = self.accounts.get(split.get(f"{side}_id") or "")
+            if account:
+                split[f"{side}_name"] = account["attributes"]["name"]
+        split.setdefault("category_name", None)
+        split.setdefault("category_id", None)
+        split.setdefault("budget_id", None)
+        self.transactions[tx_id] = {"type": "transactions", "id": tx_id, "attributes": {
+            "group_title": None, "transactions": [split]}}
+
+    def create(self, payload):
+        with self.lock:
+            tx_id = str(self.next_id)
+            self.next_id += 1
+            self._add_transaction(tx_id, payload["transactions"][0])
+            return self.transactions[tx_id]
+
+    def update(self, tx_id, payload):
+        with self.lock:
+            tx = self.transactions.get(tx_id)
+            if tx:
+                tx["attributes"]["transactions"][0].update(payload["transactions"][0])
+            return tx
+
+    def delete(self, tx_id):
+        with self.lock:
+            return self.transactions.pop(tx_id, None) is not None
+
+    def list_transactions(self, tx_type, start=None, end=None):
+        items = list(self.transactions.values())
+        if tx_type in ("expense", "withdrawal"):
+            items = [tx for tx in items if tx["attributes"]["transactions"][0]["type"] == "withdrawal"]
+        if start:
+            items = [tx for tx in items if tx["attributes"]["transactions"][0]["date"][:10] >= start]
+        if end:
+            items = [tx for tx in items if tx["attributes"]["transactions"][0]["date"][:10] <= end]
+        return sorted(items, key=lambda tx: tx["attributes"]["transactions"][0]["date"], reverse=True)
+
+    def list_accounts(self, account_type):
+        return [a for a in self.accounts.values() if a["attributes"]["type"] == account_type]
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    # keep-alive needs HTTP/1.1, the stdlib default is 1.0
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, body=None):
+        data = json.dumps(body).encode() if body is not None else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _page(self, items, url, query):
+        page = int(query.get("page", ["1"])[0])
+        per_page = int(query.get("limit", [PAGE_SIZE])[0])
+        total_pages = max(1, -(-len(items) // per_page))
+        body = {
+            "data": items[(page - 1) * per_page:page * per_page],
+            "meta": {"pagination": {"total": len(items), "count": per_page, "per_page": per_page,
+                                    "current_page": page, "total_pages": total_pages}},
+            "links": {},
+        }
+        if page < total_pages:
+            params = "&".join(f"{k}={v[0]}" for k, v in query.items() if k != "page")
+            body["links"]["next"] = f"http://{self.headers['Host']}{url.path}?{params}&page={page + 1}"
+        return body
+
+    def _handle(self):
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+        length = int(self.headers.get("Content-Length") or 0)
+        payload = json.loads(self.rfile.read(length)) if length else None
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        path = url.path.replace("/api/v1/", "", 1).strip("/")
+        endpoint = re.sub(r"/\d+$", "/{id}", path)
+        with server.lock:
+            server.calls[f"{self.command} {endpoint}"] += 1
+        status, body = self.route(self.command, path, endpoint, query, payload, url)
+        self._reply(status, body)
+
+    def route(self, method, path, endpoint, query, payload, url):
+        data = self.server.dataset
+        item_id = path.rsplit("/", 1)[-1]
+        if method == "GET":
+            if endpoint == "about/user":
+                return 200, {"data": {"type": "users", "id": "1", "attributes": {"email": "bench@example.com"}}}
+            if endpoint == "accounts":
+                return 200, self._page(data.list_accounts(query.get("type", ["asset"])[0]), url, query)
+            if endpoint == "transactions":
+                transactions = data.list_transactions(query.get("type", ["all"])[0], query.get("start", [None])[0],
+                                                      query.get("end", [None])[0])
+                return 200, self._page(transactions, url, query)
+            if endpoint in ("rules", "bills", "budgets", "categories"):
+                return 200, self._page(getattr(data, endpoint), url, query)
+            if endpoint == "accounts/{id}" and item_id in data.accounts:
+                return 200, {"data": data.accounts[item_id]}
+            if endpoint == "transactions/{id}" and item_id in data.transactions:
+                return 200, {"data": data.transactions[item_id]}
+        elif method == "POST" and endpoint == "transactions":
+            return 200, {"data": data.create(payload)}
+        elif method == "PUT" and endpoint == "transactions/{id}":
+            tx = data.update(item_id, payload)
+            if tx:
+                return 200, {"data": tx}
+        elif method == "DELETE" and endpoint == "transactions/{id}":
+            if data.delete(item_id):
+                return 204, None
+        return 404, {"message": "Resource not found"}
+
+    do_GET = _handle
+    do_POST = _handle
+    do_PUT = _handle
+    do_DELETE = _handle
+
+
+class StubHTTPServer(ThreadingHTTPServer):
+    # the default backlog of 5 resets connections once 8 or more requests are in flight
+    request_queue_size = 128
+
+
+class StubServer(object):
+    def __init__(self, latency=0.0, dataset=None, handler=StubHandler):
+        self.httpd = StubHTTPServer(("127.0.0.1", 0), handler)
+        self.httpd.daemon_threads = True
+        self.httpd.latency = latency
+        self.httpd.dataset = dataset or Dataset()
+        self.httpd.calls = Counter()
+        self.httpd.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address
+        return f"http://{host}:{port}"
+
+    @property
+    def calls(self):
+        with self.httpd.lock:
+            return Counter(self.httpd.calls)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
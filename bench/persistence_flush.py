@@ -0,0 +1,86 @@
+"""
+Compare PicklePersistence with SQLitePersistence for a bot with many users.
+
+    python bench/persistence_flush.py [users] [updates]
+
+Measures the time to persist one changed user (what the dispatcher does after every
+update), the time of a final flush, and the memory needed to start up.
+"""
+import gc
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+from telegram.ext import PicklePersistence
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+from persistence import SQLitePersistence, migrate_pickle  # noqa: E402
+
+
+def user_data(user_id):
+    return {
+        "firefly_url": f"https://firefly{user_id}.example.com",
+        "firefly_token": "x" * 900,
+        "firefly_default_account": str(user_id % 50),
+        "firefly_split": {"name": "Split Balance", "id": str(user_id % 7)},
+        "description": "Coffee",
+    }
+
+
+def populate(path, users):
+    persistence = PicklePersistence(filename=str(path))
+    persistence.get_user_data()
+    persistence.get_chat_data()
+    persistence.get_bot_data()
+    persistence.get_conversations("expense")
+    for user_id in range(users):
+        persistence.user_data[user_id] = user_data(user_id)
+    persistence.flush()
+
+
+def run(name, persistence, users, updates):
+    gc.collect()
+    tracemalloc.start()
+    data = persistence.get_user_data()
+    persistence.get_chat_data()
+    persistence.get_bot_data()
+    persistence.get_conversations("expense")
+    startup_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    timings = []
+    for i in range(updates):
+        user_id = (i * 7919) % users
+        record = dict(data[user_id], description=f"Expense {i}")
+        data[user_id] = record
+        start = time.perf_counter()
+        persistence.update_user_data(user_id, record)
+        timings.append((time.perf_counter() - start) * 1000)
+
+    start = time.perf_counter()
+    persistence.flush()
+    flush = (time.perf_counter() - start) * 1000
+    p99 = sorted(timings)[int(updates * 0.99) - 1]
+    print(f"{name:<8} update mean {statistics.mean(timings):8.3f} ms  p99 {p99:8.3f} ms  "
+          f"flush {flush:8.3f} ms  startup memory {startup_memory / 1024 / 1024:7.2f} MiB")
+
+
+def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    updates = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    with tempfile.TemporaryDirectory() as tmp:
+        pickle_file = Path(tmp) / "bot-data"
+        db_file = Path(tmp) / "bot-data.sqlite"
+        populate(pickle_file, users)
+        migrate_pickle(pickle_file, db_file)
+        print(f"{users} users, {updates} updates")
+        run("pickle", PicklePersistence(filename=str(pickle_file)), users, updates)
+        run("sqlite", SQLitePersistence(filename=db_file), users, updates)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+"""
+Compare per-call latency of one-shot requests against the pooled Firefly session.
+
+    python bench/session_latency.py [calls]
+"""
+import statistics
+import sys
+import time
+from pathlib import Path
+
+import requests
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+from firefly import Firefly, close_sessions, host_limiter  # noqa: E402
+from firefly_stub import StubServer  # noqa: E402
+
+
+def measure(call, calls):
+    timings = []
+    for _ in range(calls):
+        start = time.perf_counter()
+        call()
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def report(name, timings):
+    timings = sorted(timings)
+    p99 = timings[int(len(timings) * 0.99) - 1]
+    print(f"{name:<10} mean {statistics.mean(timings):7.3f} ms  "
+          f"median {statistics.median(timings):7.3f} ms  p99 {p99:7.3f} ms")
+
+
+def main():
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    # the per host rate limit would set the pace of the pooled calls, not the connection reuse
+    host_limiter.configure(None, 0)
+    with StubServer() as server:
+        url = server.url + "/api/v1/about/user"
+        headers = {"Authorization": "Bearer bench"}
+        one_shot = measure(lambda: requests.get(url, headers=headers).json(), calls)
+
+        firefly = Firefly(hostname=server.url, auth_token="bench")
+        pooled = measure(firefly.get_about_user, calls)
+        close_sessions()
+
+    report("one-shot", one_shot)
+    report("pooled", pooled)
+    saved = statistics.mean(one_shot) - statistics.mean(pooled)
+    print(f"saved per call: {saved:.3f} ms")
+
+
+if __name__ == "__main__":
+    main()
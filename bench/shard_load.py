@@ -0,0 +1,106 @@
+"""
+Updates per second of the multi-process mode with a growing number of worker
+processes, for handlers that keep a CPU core busy.
+
+    python bench/shard_load.py [--updates N] [--users N] [--handler-ms MS] [--processes 1,2,4]
+
+Updates are posted to the webhook listener of a front end, which routes them by user
+to the workers like `BOT_PROCESSES` does. Each handler spins for `--handler-ms` of
+CPU time. One process tops out at one core, so the scaling can't exceed the number
+of cores of the machine, which is printed first.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from pathlib import Path
+
+import requests
+from telegram.ext import Filters, MessageHandler, Updater
+from telegram.utils.request import Request
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+from bot import create_updater, start_updater  # noqa: E402
+from dispatch import UpdateQueue  # noqa: E402
+from shard import ShardRouter, Workers, feed  # noqa: E402
+from webhook_load import TOKEN, FakeBot, free_port  # noqa: E402
+
+
+def worker(results, handler_time, index, count, queue):
+    updater = create_updater(TOKEN, None, bot_class=FakeBot)
+
+    def handle(update, context):
+        end = time.perf_counter() + handler_time
+        while time.perf_counter() < end:
+            pass
+        results.put((index, update.effective_user.id))
+
+    updater.dispatcher.add_handler(MessageHandler(Filters.text, handle))
+    results.put("ready")
+    feed(updater, queue)
+
+
+def updates(count, users):
+    for update_id in range(1, count + 1):
+        user = {"id": 1000 + update_id % users, "is_bot": False, "first_name": "Bench"}
+        yield {"update_id": update_id, "message": {
+            "message_id": update_id, "date": int(time.time()), "from": user,
+            "chat": {"id": user["id"], "type": "private"}, "text": f"{update_id}, Coffee"}}
+
+
+def run(processes, args):
+    port = free_port()
+    os.environ.update(WEBHOOK_URL=f"http://127.0.0.1:{port}", WEBHOOK_LISTEN="127.0.0.1",
+                      WEBHOOK_PORT=str(port), WEBHOOK_PATH="hook")
+    results = multiprocessing.get_context("spawn").Queue()
+    workers = Workers(partial(worker, results, args.handler_ms / 1000), processes)
+    workers.start()
+    for _ in range(processes):
+        results.get(timeout=60)
+
+    router = ShardRouter(FakeBot(TOKEN, request=Request(con_pool_size=8)), UpdateQueue(), workers)
+    updater = Updater(dispatcher=router, workers=None, use_context=True)
+    start_updater(updater)
+    time.sleep(0.5)
+
+    session = requests.Session()
+    url = f"http://127.0.0.1:{port}/hook"
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        executor.map(lambda data: session.post(url, data=json.dumps(data),
+                                               headers={"Content-Type": "application/json"}),
+                     updates(args.updates, args.users))
+    handled_by = {}
+    for _ in range(args.updates):
+        index, user_id = results.get(timeout=120)
+        handled_by.setdefault(user_id, set()).add(index)
+    elapsed = time.perf_counter() - start
+    updater.stop()
+    workers.stop()
+
+    # every user has to be handled by one worker only, or its conversations would split up
+    moved = sum(1 for indexes in handled_by.values() if len(indexes) > 1)
+    print(f"{processes:>9} {args.updates / elapsed:10.1f} updates/s  users on more than one worker: {moved}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--updates", type=int, default=2000)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--handler-ms", type=float, default=2, help="CPU time spent per update")
+    parser.add_argument("--processes", default="1,2,4")
+    args = parser.parse_args()
+
+    print(f"{os.cpu_count()} CPU cores")
+    print(f"{'processes':>9} {'throughput':>21}")
+    for processes in (int(n) for n in args.processes.split(",")):
+        run(processes, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""
+Peak memory of going through a large ledger, decoding whole pages with
+`response.json()` vs. the streaming decoder.
+
+    python bench/stream_memory.py [--transactions N] [--page-size N]
+
+Each mode sums up the amounts of every transaction in a fresh subprocess, so the
+reported peak RSS belongs to the client alone. The Firefly stub runs in this process.
+"""
+import argparse
+import resource
+import subprocess
+import sys
+import time
+from decimal import Decimal
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+import firefly  # noqa: E402
+from firefly_stub import Dataset, StubServer  # noqa: E402
+from models import Transaction  # noqa: E402
+
+MODES = ("json", "stream")
+
+
+def peak_rss():
+    """Peak resident memory in KiB. ru_maxrss would include the parent's peak, it survives exec"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def client(url, mode, page_size):
+    firefly.STREAM_PAGE_SIZE = page_size
+    client = firefly.Firefly(url, "bench-token")
+    baseline = peak_rss()
+    start = time.perf_counter()
+    if mode == "json":
+        transactions = client._iter("transactions", params={"type": "all", "limit": page_size}, model=Transaction)
+    else:
+        transactions = client.stream_transactions()
+    count, total = 0, Decimal(0)
+    for tx in transactions:
+        count += 1
+        total += tx.split.amount
+    elapsed = time.perf_counter() - start
+    peak = peak_rss()
+    print(f"{mode:<7} {count:>8} transactions  total {total:>12}  {elapsed:6.2f}s  "
+          f"peak RSS {peak / 1024:7.1f} MiB (+{(peak - baseline) / 1024:.1f} MiB)")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--transactions", type=int, default=20000)
+    parser.add_argument("--page-size", type=int, default=5000)
+    parser.add_argument("--client", nargs=2, metavar=("URL", "MODE"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.client:
+        client(*args.client, args.page_size)
+        return
+
+    dataset = Dataset(expense_accounts=50, rules=0, transactions=args.transactions)
+    with StubServer(dataset=dataset) as server:
+        for mode in MODES:
+            subprocess.run([sys.executable, __file__, "--page-size", str(args.page_size),
+                            "--client", server.url, mode], check=True)
+
+
+if __name__ == "__main__":
+    main()
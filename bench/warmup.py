@@ -0,0 +1,80 @@
+"""
+Latency of the first commands of a session after the reference cache went cold,
+with and without the background warm-up having run for the user.
+
+    python bench/warmup.py [--runs N] [--latency MS] [--accounts N] [--rules N]
+
+Each run clears the shared cache, as if the user had been away for longer than
+`CACHE_TTL`, then sends `/expense`, a one line expense and `/balance` and times them.
+"""
+import argparse
+import statistics
+import sys
+import tempfile
+import time
+import warnings
+from pathlib import Path
+from queue import Queue
+
+from telegram import Bot
+from telegram.ext import Dispatcher
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+import bot  # noqa: E402
+from e2e import USER, Driver, FakeRequest, flow_balance, flow_expense, flow_quick  # noqa: E402
+from firefly_stub import Dataset, StubServer  # noqa: E402
+from mirror import TransactionMirror  # noqa: E402
+from outbox import Outbox, OutboxWorker  # noqa: E402
+from persistence import SQLitePersistence  # noqa: E402
+from warmup import Warmup  # noqa: E402
+
+FLOWS = [flow_expense, flow_quick, flow_balance]
+
+
+def main():
+    warnings.filterwarnings("ignore", message="If 'per_message=False'")
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--latency", type=float, default=30, help="added to every Firefly call, in ms")
+    parser.add_argument("--accounts", type=int, default=500)
+    parser.add_argument("--rules", type=int, default=200)
+    args = parser.parse_args()
+
+    dataset = Dataset(expense_accounts=args.accounts, rules=args.rules, transactions=500)
+    with StubServer(latency=args.latency / 1000, dataset=dataset) as server, tempfile.TemporaryDirectory() as tmp:
+        request = FakeRequest()
+        dispatcher = Dispatcher(Bot("123456:bench", request=request), Queue(), use_context=True)
+        bot.add_handlers(dispatcher)
+        bot.outbox = Outbox(Path(tmp) / "outbox.sqlite")
+        bot.transaction_mirror = TransactionMirror(Path(tmp) / "transactions.sqlite")
+        bot.outbox_worker = OutboxWorker(bot.outbox, notify=lambda chat_id, text: None)
+        persistence = SQLitePersistence(Path(tmp) / "bot-data.sqlite")
+        bot.warmup = Warmup(persistence, bot.warm_up)
+        user_data = dispatcher.user_data[USER["id"]]
+        user_data.update(firefly_url=server.url, firefly_token="bench-token", firefly_default_account="1")
+        driver = Driver(dispatcher, request)
+
+        print(f"{'mode':<6} " + " ".join(f"{flow.__name__[5:]:>9}" for flow in FLOWS) + f" {'calls':>7}")
+        for mode in ("cold", "warm"):
+            timings = {flow: [] for flow in FLOWS}
+            calls = 0
+            for _ in range(args.runs):
+                bot.reference_cache.clear()
+                if mode == "warm":
+                    bot.warm_up(user_data)
+                calls_before = server.calls
+                for flow in FLOWS:
+                    start = time.perf_counter()
+                    flow(driver, server)
+                    timings[flow].append((time.perf_counter() - start) * 1000)
+                calls += sum((server.calls - calls_before).values())
+            print(f"{mode:<6} " + " ".join(f"{statistics.mean(timings[flow]):7.1f}ms" for flow in FLOWS)
+                  + f" {calls / args.runs:7.1f}")
+        bot.outbox.close()
+        bot.transaction_mirror.close()
+        persistence.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+"""
+Replay Telegram updates into the bot locally, once through the webhook listener and
+once through long polling, and compare throughput and handler latency.
+
+    python bench/webhook_load.py [--updates N] [--rate PER_SECOND] [--recorded FILE]
+
+`--recorded` takes a file with one Update JSON object per line; without it synthetic
+text messages are generated. Telegram itself is replaced by a stub, polling pays a
+simulated round trip per getUpdates call.
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import requests
+from telegram import Bot, Update, User
+from telegram.ext import Filters, MessageHandler
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+from bot import create_updater, start_updater  # noqa: E402
+
+TOKEN = "123456:bench"
+POLL_ROUND_TRIP = 0.05
+
+
+class FakeTelegram(object):
+    def __init__(self):
+        self.pending = []
+        self.condition = threading.Condition()
+
+    def push(self, data):
+        with self.condition:
+            self.pending.append(data)
+            self.condition.notify_all()
+
+    def take(self, offset, limit, timeout):
+        with self.condition:
+            self.condition.wait_for(lambda: any(u["update_id"] >= (offset or 0) for u in self.pending), timeout)
+            self.pending = [u for u in self.pending if u["update_id"] >= (offset or 0)]
+            return self.pending[:limit]
+
+
+class FakeBot(Bot):
+    telegram = FakeTelegram()
+
+    def get_me(self, *args, **kwargs):
+        self.bot = User(id=123456, first_name="Bench", is_bot=True, username="bench_bot")
+        return self.bot
+
+    def get_my_commands(self, *args, **kwargs):
+        self._commands = []
+        return self._commands
+
+    def set_webhook(self, *args, **kwargs):
+        return True
+
+    def delete_webhook(self, *args, **kwargs):
+        return True
+
+    def get_updates(self, offset=None, limit=100, timeout=0, *args, **kwargs):
+        time.sleep(POLL_ROUND_TRIP)
+        return [Update.de_json(data, self) for data in self.telegram.take(offset, limit, timeout)]
+
+
+def synthetic_updates(count):
+    for update_id in range(1, count + 1):
+        user = {"id": 1000 + update_id % 50, "is_bot": False, "first_name": "Bench"}
+        yield {"update_id": update_id, "message": {
+            "message_id": update_id, "date": int(time.time()), "from": user,
+            "chat": {"id": user["id"], "type": "private"}, "text": f"{update_id}, Coffee"}}
+
+
+def recorded_updates(path, count):
+    with open(path) as f:
+        updates = [json.loads(line) for line in f if line.strip()]
+    for i in range(count):
+        yield dict(updates[i % len(updates)], update_id=i + 1)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def run(mode, updates, rate, handler_time):
+    port = free_port()
+    if mode == "webhook":
+        os.environ.update(WEBHOOK_URL=f"http://127.0.0.1:{port}", WEBHOOK_LISTEN="127.0.0.1",
+                          WEBHOOK_PORT=str(port), WEBHOOK_PATH="hook")
+    else:
+        os.environ.pop("WEBHOOK_URL", None)
+    FakeBot.telegram = FakeTelegram()
+
+    produced = {}
+    latencies = []
+    done = threading.Event()
+
+    def handle(update, context):
+        time.sleep(handler_time)
+        latencies.append(time.perf_counter() - produced[update.update_id])
+        if len(latencies) == len(updates):
+            done.set()
+
+    updater = create_updater(TOKEN, None, bot_class=FakeBot)
+    updater.dispatcher.add_handler(MessageHandler(Filters.text, handle))
+    start_updater(updater)
+    time.sleep(0.5)
+
+    session = requests.Session()
+    url = f"http://127.0.0.1:{port}/hook"
+
+    def deliver(data):
+        produced[data["update_id"]] = time.perf_counter()
+        if mode == "webhook":
+            session.post(url, data=json.dumps(data), headers={"Content-Type": "application/json"})
+        else:
+            FakeBot.telegram.push(data)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        for i, data in enumerate(updates):
+            delay = start + i / rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(deliver, data)
+    done.wait(120)
+    elapsed = time.perf_counter() - start
+    updater.stop()
+
+    latencies = sorted(latencies)
+    p99 = latencies[int(len(latencies) * 0.99) - 1] * 1000
+    print(f"{mode:<8} {len(latencies) / elapsed:8.1f} updates/s  "
+          f"median {statistics.median(latencies) * 1000:7.2f} ms  p99 {p99:7.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--updates", type=int, default=2000)
+    parser.add_argument("--rate", type=float, default=200, help="updates sent per second")
+    parser.add_argument("--handler-ms", type=float, default=1, help="simulated work per update")
+    parser.add_argument("--recorded", help="file with one Update JSON per line")
+    args = parser.parse_args()
+
+    if args.recorded:
+        updates = list(recorded_updates(args.recorded, args.updates))
+    else:
+        updates = list(synthetic_updates(args.updates))
+    for mode in ("webhook", "polling"):
+        run(mode, updates, args.rate, args.handler_ms / 1000)
+
+
+if __name__ == "__main__":
+    main()
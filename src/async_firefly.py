@@ -0,0 +1,357 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from urllib.parse import urlparse
+
+import requests
+
+import metrics
+from firefly import (BULK_CONCURRENCY, DEFAULT_TIMEOUT, POOL_MAXSIZE, SPLIT_BALANCE_ACCOUNT, TX_DEPENDENT_RESOURCES,
+                     BulkResult, Firefly, bulk_result, date_range, get_session, host_limiter, name_index,
+                     transaction_payload, update_payload, withdrawal_payload)
+from models import Account, Budget, Category, Rule, Transaction
+from throttle import retry_after
+
+# requests in flight per Firefly host, the thread pool is larger so one slow host can't fill it
+HOST_CONCURRENCY = POOL_MAXSIZE
+HTTP_THREADS = 4 * HOST_CONCURRENCY
+
+_loop = None
+# the blocking calls of the shared keep-alive sessions
+_executor = ThreadPoolExecutor(max_workers=HTTP_THREADS, thread_name_prefix="firefly-http")
+_loop_lock = threading.Lock()
+# identical GETs in flight share one request, only touched from the loop thread
+_inflight = {}
+# per host semaphores capping the threads taken by a host, only touched from the loop thread
+_host_slots = {}
+
+
+def get_loop():
+    """Return the event loop running the async Firefly calls, starting it on first use."""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=_loop.run_forever, name="firefly-async", daemon=True)
+            thread.start()
+        return _loop
+
+
+def run_coroutine(coro, timeout=None):
+    """Run a coroutine on the shared loop and wait for its result, for use from sync handlers."""
+    return asyncio.run_coroutine_threadsafe(coro, get_loop()).result(timeout)
+
+
+def run_concurrently(*coros, timeout=None):
+    """Run independent coroutines at the same time and return their results in order."""
+    async def gather():
+        return await asyncio.gather(*coros)
+    return run_coroutine(gather(), timeout)
+
+
+class AsyncFirefly(object):
+    """
+    Non-blocking counterpart of `Firefly`. Every method is a coroutine with the same
+    name and arguments as in `Firefly`. Requests go through the same keep-alive session
+    as `Firefly` on a shared thread pool, so connections are reused. Each host gets at
+    most `HOST_CONCURRENCY` of its threads, further requests to the host wait on the
+    loop without taking a thread from the other hosts.
+    """
+
+    def __init__(self, hostname, auth_token, timeout=DEFAULT_TIMEOUT, cache=None, mirror=None,
+                 min_ttl=0):
+        self.hostname = hostname + "/api/v1/"
+        self.timeout = timeout
+        self.session = get_session(hostname, auth_token)
+        self.cache = cache
+        self.mirror = mirror
+        self.cache_key = (hostname, auth_token)
+        # cached listings expiring sooner than this are loaded again, see warmup.py
+        self.min_ttl = min_ttl
+        self.host = urlparse(hostname).netloc
+
+    _url = Firefly._url
+    _next_page = staticmethod(Firefly._next_page)
+    _record = Firefly._record
+
+    async def _request(self, method, endpoint, params=None, payload=None):
+        url = self._url(endpoint)
+        delay = host_limiter.reserve(self.host)
+        if delay:
+            metrics.firefly_throttle_seconds.inc(delay)
+            await asyncio.sleep(delay)
+        # retries of idempotent calls happen in the session, as for `Firefly`
+        call = partial(self.session.request, method, url, params=params, json=payload, timeout=self.timeout)
+        slots = _host_slots.get(self.host)
+        if slots is None:
+            slots = _host_slots[self.host] = asyncio.Semaphore(HOST_CONCURRENCY)
+        async with slots:
+            start = time.perf_counter()
+            status, size, wait = "error", 0, None
+            try:
+                response = await asyncio.get_running_loop().run_in_executor(_executor, call)
+                status, size = response.status_code, len(response.content)
+                wait = retry_after(response.headers)
+                return response
+            finally:
+                host_limiter.feedback(self.host, status, wait)
+                metrics.record_request(method, url, status, time.perf_counter() - start, size)
+
+    async def _post(self, endpoint, payload):
+        return await self._request("POST", endpoint, payload=payload)
+
+    async def _put(self, endpoint, payload):
+        return await self._request("PUT", endpoint, payload=payload)
+
+    async def _delete(self, endpoint):
+        return await self._request("DELETE", endpoint)
+
+    async def _get(self, endpoint, params=None):
+        return await self._get_json(endpoint, params)
+
+    async def _get_page(self, endpoint, params=None):
+        return await self._get_json(endpoint, params, check=True)
+
+    async def _fetch_json(self, endpoint, params, check):
+        response = await self._request("GET", endpoint, params=params)
+        if check:
+            response.raise_for_status()
+        return response.json()
+
+    async def _get_json(self, endpoint, params=None, check=False):
+        url = self._url(endpoint)
+        key = (self.cache_key, url, tuple(sorted((params or {}).items())), check)
+        task = _inflight.get(key)
+        if task is None:
+            task = _inflight[key] = asyncio.ensure_future(self._fetch_json(endpoint, params, check))
+            task.add_done_callback(lambda _: _inflight.pop(key, None))
+        else:
+            metrics.firefly_coalesced_requests.inc(1, metrics.endpoint_name(url))
+        # a caller giving up, eg a cancelled prefetch, must not cancel the others
+        return await asyncio.shield(task)
+
+    async def _iter(self, endpoint, params=None, model=None):
+        page = await self._get_page(endpoint, params=params)
+        while True:
+            next_endpoint, next_params = self._next_page(page, endpoint, params)
+            upcoming = None
+            if next_endpoint:
+                upcoming = asyncio.ensure_future(self._get_page(next_endpoint, next_params))
+            try:
+                for item in page.get("data", []):
+                    yield model.from_json(item) if model else item
+            except GeneratorExit:
+                if upcoming is not None:
+                    upcoming.cancel()
+                raise
+            if upcoming is None:
+                return
+            page = await upcoming
+
+    async def _cached_list(self, resource, loader, *args):
+        key = (self.cache_key, resource) + args
+        missing = object()
+        value = self.cache.get(key, missing, self.min_ttl) if self.cache is not None else missing
+        if value is missing:
+            value = [item async for item in loader(*args)]
+            if self.cache is not None:
+                self.cache.set(key, value)
+        return value
+
+    async def _cached_index(self, resource, loader, *args):
+        key = (self.cache_key, resource) + args
+        missing = object()
+        value = self.cache.get(key, missing, self.min_ttl) if self.cache is not None else missing
+        if value is missing:
+            value = name_index([item async for item in loader(*args)])
+            if self.cache is not None:
+                self.cache.set(key, value)
+        return value
+
+    def _invalidate(self, resources=TX_DEPENDENT_RESOURCES):
+        if self.cache is not None:
+            self.cache.invalidate(lambda key: key[0] == self.cache_key and key[1] in resources)
+
+    async def get_transactions(self, tx_type="all"):
+        return await self._get("transactions", params={"type": tx_type})
+
+    def iter_transactions(self, tx_type="all", start=None, end=None):
+        return self._iter("transactions", params=date_range({"type": tx_type}, start, end), model=Transaction)
+
+    async def get_transaction(self, tx_id):
+        return await self._get(f"transactions/{tx_id}")
+
+    async def load_transaction(self, tx_id):
+        data = (await self.get_transaction(tx_id)).get("data")
+        return Transaction.from_json(data) if data else None
+
+    async def delete_transaction(self, tx_id):
+        response = await self._delete(f"transactions/{tx_id}")
+        self._invalidate()
+        self._record(response, deleted_id=tx_id)
+        return response
+
+    async def get_budgets(self):
+        return await self._get("budgets")
+
+    def iter_budgets(self):
+        return self._iter("budgets", model=Budget)
+
+    async def list_budgets(self):
+        return await self._cached_list("budgets", self.iter_budgets)
+
+    async def budget_names(self):
+        return await self._cached_index("budget_names", self.iter_budgets)
+
+    async def get_categories(self):
+        return await self._get("categories")
+
+    def iter_categories(self):
+        return self._iter("categories", model=Category)
+
+    async def list_categories(self):
+        return await self._cached_list("categories", self.iter_categories)
+
+    async def category_names(self):
+        return await self._cached_index("category_names", self.iter_categories)
+
+    async def get_accounts(self, account_type="asset"):
+        return await self._get("accounts", params={"type": account_type})
+
+    def iter_accounts(self, account_type="asset"):
+        return self._iter("accounts", params={"type": account_type}, model=Account)
+
+    async def list_accounts(self, account_type="asset"):
+        return await self._cached_list("accounts", self.iter_accounts, account_type)
+
+    async def account_names(self, account_type="asset"):
+        return await self._cached_index("account_names", self.iter_accounts, account_type)
+
+    async def get_rules(self):
+        return await self._get("rules")
+
+    def iter_rules(self):
+        return self._iter("rules", model=Rule)
+
+    async def list_rules(self):
+        return await self._cached_list("rules", self.iter_rules)
+
+    async def get_account(self, account_id):
+        return await self._get(f"accounts/{account_id}")
+
+    async def load_account(self, account_id):
+        data = (await self.get_account(account_id)).get("data")
+        return Account.from_json(data) if data else None
+
+    async def get_bills(self):
+        return await self._get("bills")
+
+    def iter_bills(self):
+        return self._iter("bills")
+
+    async def list_bills(self):
+        return await self._cached_list("bills", self.iter_bills)
+
+    async def get_about_user(self):
+        return await self._get("about/user")
+
+    async def update_transaction(self, transaction_id, **kwargs):
+        payload = update_payload(**kwargs)
+        response = await self._put(endpoint=f"transactions/{transaction_id}", payload=payload)
+        self._invalidate()
+        self._record(response)
+        return response
+
+    async def create_transaction(self, **kwargs):
+        payload = transaction_payload(**kwargs)
+        response = await self._post(endpoint="transactions", payload=payload)
+        self._invalidate()
+        self._record(response)
+        return response
+
+    async def create_transaction_group(self, payload):
+        response = await self._post(endpoint="transactions", payload=payload)
+        self._invalidate()
+        self._record(response)
+        return response
+
+    async def create_withdrawal(self, amount, description, source_account, destination_account=None, category=None, budget=None):
+        payload = withdrawal_payload(amount, description, source_account, destination_account, category, budget)
+        response = await self._post(endpoint="transactions", payload=payload)
+        self._invalidate()
+        self._record(response)
+        return response
+
+    async def create_transactions(self, payloads, concurrency=BULK_CONCURRENCY):
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def submit(index, payload):
+            async with semaphore:
+                try:
+                    response = await self._post(endpoint="transactions", payload=payload)
+                except Exception as e:
+                    return BulkResult(index, None, None, str(e))
+            self._record(response)
+            return bulk_result(index, response)
+
+        results = await asyncio.gather(*(submit(index, payload) for index, payload in enumerate(payloads)))
+        self._invalidate()
+        return results
+
+    async def split_transaction(self, tx, ratio, index=0):
+        """
+        Reduce a withdrawal to 1/`ratio` of its amount and book the rest as a transfer to
+        the split balance account. Both requests go out at once, if only one of them
+        succeeds it is undone, so a transaction is never left half split. Returns a
+        `BulkResult` carrying the id of the transfer.
+        """
+        split = tx.split
+        new_amount = (split.amount / ratio).quantize(split.quantum)
+        description = "[Split] - " + split.description
+        update, create = await asyncio.gather(
+            self.update_transaction(tx.id, amount=new_amount, description=description),
+            self.create_transaction(type="transfer", amount=split.amount - new_amount, description=description,
+                                    source_id=split.source_id, destination_name=SPLIT_BALANCE_ACCOUNT,
+                                    category_id=split.category_id, budget_id=split.budget_id, date=split.date),
+            return_exceptions=True)
+        updated = not isinstance(update, Exception) and update.status_code == 200
+        created = bulk_result(index, create) if not isinstance(create, Exception) else BulkResult(
+            index, None, None, str(create))
+        if updated and created.tx_id:
+            return created
+        if created.status_code == 200 and not created.tx_id:
+            # the transfer most likely exists, undoing the update would leave the opposite half split
+            return BulkResult(index, 200, None, "Firefly created the transfer without returning its id"
+                                                + ("" if updated else " and did not update the expense")
+                                                + ", please check the transaction")
+        error = (created.error if updated else
+                 str(update) if isinstance(update, Exception) else bulk_result(index, update).error)
+        error = error or "unexpected response"
+        try:
+            if updated:
+                undo = await self.update_transaction(tx.id, amount=split.amount, description=split.description)
+            elif created.tx_id:
+                undo = await self.delete_transaction(created.tx_id)
+            else:
+                undo = None
+            if undo is not None and undo.status_code not in (200, 204):
+                raise requests.HTTPError(f"HTTP {undo.status_code}")
+        except Exception as e:
+            error += f", undoing the other half failed ({e}), please check the transaction"
+        return BulkResult(index, created.status_code, None, error)
+
+    async def split_transactions(self, transactions, ratio, concurrency=BULK_CONCURRENCY):
+        """`split_transaction` for many transactions, at most `concurrency` of them at a time. Results are in order"""
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def submit(index, tx):
+            async with semaphore:
+                # one broken split must not cost the results of the others
+                try:
+                    return await self.split_transaction(tx, ratio, index)
+                except Exception as e:
+                    return BulkResult(index, None, None, str(e) or type(e).__name__)
+
+        return await asyncio.gather(*(submit(index, tx) for index, tx in enumerate(transactions)))
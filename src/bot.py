@@ -5,26 +5,71 @@
 """
 Basic example for a bot that uses inline keyboards.
 """
+import io
 import json
 import logging
 import os
+import signal
+import sys
+from decimal import Decimal, InvalidOperation
+from itertools import islice
 from pathlib import Path
 
-from firefly import Firefly
-from telegram import (InlineKeyboardButton, InlineKeyboardMarkup,
-                      ReplyKeyboardRemove, Update, ReplyKeyboardMarkup)
+from async_firefly import AsyncFirefly, run_concurrently, run_coroutine
+import metrics
+from cache import TTLCache
+from dispatch import LaneDispatcher, UpdateQueue, UserLanes
+from expense import ExpenseError, expense_payload, needs_lookup, parse_expense
+from firefly import DEFAULT_BURST, DEFAULT_RATE, Firefly, host_limiter, withdrawal_payload
+from importer import StatementError, decode_statement, read_statement
+from matcher import get_rule_matcher
+from mirror import TransactionMirror
+from outbox import Outbox, OutboxWorker
+from persistence import SQLitePersistence, migrate_pickle
+from report import ReportError, build_report, format_report, parse_months
+from shard import ShardRouter, Workers, feed
+from tokens import CallbackTokens
+from typeahead import get_account_index
+from warmup import Warmup
+from telegram import (Bot, InlineKeyboardButton, InlineKeyboardMarkup, InlineQueryResultArticle,
+                      InputTextMessageContent, ReplyKeyboardRemove, Update)
 from telegram.ext import (CallbackQueryHandler, CommandHandler, RegexHandler,
-                          ConversationHandler, Filters, MessageHandler,
-                          PicklePersistence, Updater, CallbackContext)
+                          ConversationHandler, Filters, InlineQueryHandler, JobQueue, MessageHandler,
+                          TypeHandler, Updater, CallbackContext)
+from telegram.utils.request import Request
 
 logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
                     level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# accounts, rules, budgets and bills of all users, shared across conversations
+reference_cache = TTLCache(maxsize=int(os.getenv("CACHE_MAX_ENTRIES", 1024)),
+                           ttl=int(os.getenv("CACHE_TTL", 300)))
+# payloads of inline keyboard buttons, the buttons only carry a token
+callback_tokens = CallbackTokens(maxsize=int(os.getenv("CALLBACK_TOKENS_MAX", 10000)),
+                                 ttl=int(os.getenv("CALLBACK_TOKENS_TTL", 24 * 3600)))
+# durable queue of expenses not yet delivered to Firefly, set up in main()
+outbox = None
+outbox_worker = None
+# local copy of the users' transactions, set up in main()
+transaction_mirror = None
+# jobs keeping the reference data of active users loaded, set up in main()
+warmup = None
+
 FIREFLY_URL, FIREFLY_TOKEN, DEFAULT_WITHDRAW_ACCOUNT = range(3)
 DESCRIPTION, SOURCE, DEST, AMOUNT = range(4)
 SELECT, SPLIT, SET_SPLIT_ACCOUNT = range(3)
 SHOW, DETAILS = range(2)
+BATCH_SELECT, BATCH_RATIO = range(2)
+UPLOAD_STATEMENT = 0
+
+IMPORT_BATCH_SIZE = 50
+PAGE_SIZE = 8
+INLINE_RESULTS = 20
+BATCH_SPLIT_MAX = 50
+BATCH_SPLIT_CONCURRENCY = int(os.getenv("SPLIT_CONCURRENCY", 4))
+# failures listed in the summary of an import or batch split
+REPORTED_FAILURES = 10
 
 def start(update, context):
     update.message.reply_text("Please enter your Firefly III URL")
@@ -44,13 +89,10 @@ def get_default_account(update, context):
     token = update.message.text
     firefly = Firefly(hostname=context.user_data.get(
         "firefly_url"), auth_token=token)
-    accounts = firefly.get_accounts(account_type="asset").get("data")
-
     accounts_keyboard = []
-    for account in accounts:
-        account_name = account.get("attributes").get("name")
+    for account in firefly.iter_accounts(account_type="asset"):
         accounts_keyboard.append([InlineKeyboardButton(
-            account_name, callback_data=account.get("id"))])
+            account.name, callback_data=account.id)])
 
     reply_markup = InlineKeyboardMarkup(accounts_keyboard)
 
@@ -71,7 +113,9 @@ def store_default_account(update, context):
 def store_split_account(update: Update, context: CallbackContext) -> None:
     query = update.callback_query
     query.answer()
-    asset_account = json.loads(query.data)
+    asset_account = resolve_button(query)
+    if asset_account is None:
+        return ConversationHandler.END
     context.user_data["firefly_split"] = asset_account
     query.edit_message_text("Account stored. You can now start over again by typing /split")
     return ConversationHandler.END
@@ -84,7 +128,30 @@ def about(update, context):
 
 
 def get_firefly(context):
-    return Firefly(hostname=context.user_data.get("firefly_url"), auth_token=context.user_data.get("firefly_token"))
+    return Firefly(hostname=context.user_data.get("firefly_url"), auth_token=context.user_data.get("firefly_token"),
+                   cache=reference_cache, mirror=transaction_mirror)
+
+
+def get_async_firefly(context):
+    return AsyncFirefly(hostname=context.user_data.get("firefly_url"),
+                        auth_token=context.user_data.get("firefly_token"), cache=reference_cache,
+                        mirror=transaction_mirror)
+
+
+def warm_up(user_data):
+    """Load what the first command of a session needs, run in the background by the warm-up jobs"""
+    hostname, auth_token = user_data["firefly_url"], user_data["firefly_token"]
+    # reload listings that would expire before the next warm-up
+    firefly = AsyncFirefly(hostname=hostname, auth_token=auth_token, cache=reference_cache,
+                           mirror=transaction_mirror, min_ttl=warmup.interval)
+    # the listings behind the name indexes are requested once, identical requests in flight are shared
+    _, expenses, rules, *_ = run_concurrently(
+        firefly.list_accounts("asset"), firefly.list_accounts("expense"), firefly.list_rules(),
+        firefly.account_names("asset"), firefly.account_names("expense"),
+        firefly.category_names(), firefly.budget_names())
+    get_rule_matcher(firefly.cache_key, rules)
+    get_account_index(firefly.cache_key, expenses)
+    transaction_mirror.refresh(Firefly(hostname=hostname, auth_token=auth_token, mirror=transaction_mirror))
 
 
 def show_help(update, context):
@@ -108,40 +175,101 @@ You can skip specfic fields by leaving them empty (except the first two) -
 """)
 
 
-def get_default_asset_keyboard(firefly):
-    accounts = firefly.get_accounts(account_type="asset").get("data")
+def resolve_button(query):
+    """Payload of a pressed button, None once its token has expired"""
+    payload = callback_tokens.resolve(query.data)
+    if payload is None:
+        query.edit_message_text("These buttons have expired, please start over.")
+    return payload
+
+
+def page_buttons(kind, offset, has_next):
+    """Prev/Next row of a paged keyboard, the callback data carries the offset of the page to show"""
+    buttons = []
+    if offset > 0:
+        buttons.append(InlineKeyboardButton("« Prev", callback_data=f"page:{kind}:{max(0, offset - PAGE_SIZE)}"))
+    if has_next:
+        buttons.append(InlineKeyboardButton("Next »", callback_data=f"page:{kind}:{offset + PAGE_SIZE}"))
+    return [buttons] if buttons else []
+
+
+def get_default_asset_keyboard(firefly, offset=0):
+    accounts = [a for a in firefly.list_accounts(account_type="asset") if a.role == "defaultAsset"]
+    page = accounts[offset:offset + PAGE_SIZE]
     accounts_keyboard = []
-    for i, account in enumerate(accounts):
+    for i, account in enumerate(page):
         if i % 3 == 0:
             accounts_keyboard.append([])
-        account_name = account.get("attributes").get("name")
-        account_id = account.get("id")
-        comp = dict(name=account_name, id=account_id)
-        comstr = json.dumps(comp)
-        if account.get("attributes").get("account_role") == "defaultAsset":
-            accounts_keyboard[-1].append(InlineKeyboardButton(
-                account_name, callback_data=comstr))
+        token = callback_tokens.register(dict(name=account.name, id=account.id))
+        accounts_keyboard[-1].append(InlineKeyboardButton(
+            account.name, callback_data=token))
 
+    accounts_keyboard += page_buttons("asset", offset, len(accounts) > offset + PAGE_SIZE)
     return InlineKeyboardMarkup(accounts_keyboard)
 
-def get_tx_list_keyboard(firefly):
+def get_tx_list_keyboard(firefly, offset=0):
+    if offset == 0:
+        transaction_mirror.refresh(firefly)
+    # one extra row tells whether there is a next page
+    txs = transaction_mirror.recent(firefly.cache_key, tx_type="withdrawal", limit=PAGE_SIZE + 1, offset=offset)
+    return get_tx_keyboard(txs, "tx", offset)
+
+
+def get_search_keyboard(firefly, text, offset=0):
+    txs = transaction_mirror.search(firefly.cache_key, text, limit=PAGE_SIZE + 1, offset=offset)
+    return get_tx_keyboard(txs, "search", offset)
+
+
+def get_tx_keyboard(txs, kind, offset):
     txs_keyboard = []
-    response = firefly.get_transactions(tx_type="expense").get("data")
-    response.reverse()
-    for i, tx in enumerate(response):
-        sub_tx = tx.get("attributes").get("transactions")[0]
-        tx_desc = sub_tx.get("description")
-        tx_curry = sub_tx.get("currency_symbol")
-        tx_amount = round(float(sub_tx.get("amount")), 2)
-        tx_id = tx.get("id")
-        txs_keyboard.append([InlineKeyboardButton(
-            f"{tx_desc} ({tx_curry} {tx_amount})", callback_data=tx_id)])
+    for tx in txs[:PAGE_SIZE]:
+        txs_keyboard.append([InlineKeyboardButton(tx_label(tx), callback_data=tx.id)])
+
+    txs_keyboard += page_buttons(kind, offset, len(txs) > PAGE_SIZE)
+    return InlineKeyboardMarkup(txs_keyboard)
+
 
+def tx_label(tx):
+    split = tx.split
+    return f"{split.description} ({split.currency_symbol} {split.amount:.2f})"
+
+
+def get_batch_keyboard(firefly, selected, offset=0):
+    """Latest expenses to pick for a batch split, picked ones are ticked"""
+    if offset == 0:
+        transaction_mirror.refresh(firefly)
+    txs = transaction_mirror.recent(firefly.cache_key, tx_type="withdrawal", limit=PAGE_SIZE + 1, offset=offset)
+    txs_keyboard = []
+    for tx in txs[:PAGE_SIZE]:
+        mark = "✓ " if tx.id in selected else ""
+        txs_keyboard.append([InlineKeyboardButton(mark + tx_label(tx), callback_data=f"pick:{tx.id}:{offset}")])
+    txs_keyboard += page_buttons("batch", offset, len(txs) > PAGE_SIZE)
+    txs_keyboard.append([InlineKeyboardButton(f"Done ({len(selected)})", callback_data="pick:done")])
     return InlineKeyboardMarkup(txs_keyboard)
 
 
+def turn_page(update, context):
+    query = update.callback_query
+    query.answer()
+    _, kind, offset = query.data.split(":")
+    offset = int(offset)
+    firefly = get_firefly(context)
+    if kind == "asset":
+        reply_markup = get_default_asset_keyboard(firefly, offset)
+    elif kind == "search":
+        reply_markup = get_search_keyboard(firefly, context.user_data.get("tx_search", ""), offset)
+    elif kind == "batch":
+        reply_markup = get_batch_keyboard(firefly, context.user_data.get("split_batch", []), offset)
+    else:
+        reply_markup = get_tx_list_keyboard(firefly, offset)
+    query.edit_message_reply_markup(reply_markup=reply_markup)
+
+
 def get_balance(update, context):
     firefly = get_firefly(context)
+    if context.args and context.args[0] == "all":
+        update.message.reply_text(format_balances(load_balances(context)))
+        return ConversationHandler.END
 
     reply_markup = get_default_asset_keyboard(firefly)
     update.message.reply_text(
@@ -166,19 +294,18 @@ def show_tx(update, context):
     if (len(context.args)>0):
         tx_id = int(context.args[0])
         firefly = get_firefly(context)
-        response = firefly.get_transaction(tx_id)
+        tx = (transaction_mirror.get(firefly.cache_key, tx_id) or firefly.load_transaction(tx_id)).split
         delete_button = [[
             InlineKeyboardButton("Delete", callback_data=tx_id),
             InlineKeyboardButton("Other", callback_data="other"),
             InlineKeyboardButton("Cancel", callback_data="cancel")
         ]]
         reply_markup = InlineKeyboardMarkup(delete_button)
-        tx = response['data']['attributes']['transactions'][0]
-        update.message.reply_text(f"{tx['description']} {tx['currency_symbol']} {round(float(tx['amount']), 2)} "
-                                  f"\nSource: {tx['source_name']}"
-                                  f"\nDestination: {tx['destination_name']}"
-                                  f"\nCategory: {tx['category_name']}"
-                                  f"\nDate {tx['date']}", reply_markup=reply_markup)
+        update.message.reply_text(f"{tx.description} {tx.currency_symbol} {tx.amount:.2f} "
+                                  f"\nSource: {tx.source_name}"
+                                  f"\nDestination: {tx.destination_name}"
+                                  f"\nCategory: {tx.category_name}"
+                                  f"\nDate {tx.date}", reply_markup=reply_markup)
 
         return DETAILS
 
@@ -188,6 +315,21 @@ def show_tx(update, context):
     return SHOW
 
 
+def search_tx(update, context):
+    if not context.args:
+        update.message.reply_text("Tell me what to look for, eg /search coffee")
+        return ConversationHandler.END
+    firefly = get_firefly(context)
+    transaction_mirror.refresh(firefly)
+    context.user_data["tx_search"] = " ".join(context.args)
+    reply_markup = get_search_keyboard(firefly, context.user_data["tx_search"])
+    if not reply_markup.inline_keyboard:
+        update.message.reply_text("No matching transactions")
+        return ConversationHandler.END
+    update.message.reply_text("Please chose a transaction to show", reply_markup=reply_markup)
+    return SHOW
+
+
 def delete_tx(update, context):
     firefly = get_firefly(context)
     query = update.callback_query
@@ -214,19 +356,18 @@ def show_details(update, context):
     query = update.callback_query
     query.answer()
     tx_id = query.data
-    response = firefly.get_transaction(tx_id)
+    tx = (transaction_mirror.get(firefly.cache_key, tx_id) or firefly.load_transaction(tx_id)).split
     delete_button = [[
         InlineKeyboardButton("Delete", callback_data=tx_id),
         InlineKeyboardButton("Other", callback_data="other"),
         InlineKeyboardButton("Cancel", callback_data="cancel")
     ]]
     reply_markup = InlineKeyboardMarkup(delete_button)
-    tx = response['data']['attributes']['transactions'][0]
-    query.edit_message_text(f"{tx['description']} {tx['currency_symbol']} {round(float(tx['amount']),2)} "
-                            f"\nSource: {tx['source_name']}"
-                            f"\nDestination: {tx['destination_name']}"
-                            f"\nCategory: {tx['category_name']}"
-                            f"\nDate {tx['date']}", reply_markup=reply_markup)
+    query.edit_message_text(f"{tx.description} {tx.currency_symbol} {tx.amount:.2f} "
+                            f"\nSource: {tx.source_name}"
+                            f"\nDestination: {tx.destination_name}"
+                            f"\nCategory: {tx.category_name}"
+                            f"\nDate {tx.date}", reply_markup=reply_markup)
 
     return DETAILS
 
@@ -242,76 +383,172 @@ def select_ratio(update: Update, context: CallbackContext) -> None:
     query.answer()
     tx_id = query.data
     context.user_data["split_tx_id"] = tx_id
-    ratio_keyboard = [[InlineKeyboardButton("specify amount", callback_data=0)],
-                      [InlineKeyboardButton("4", callback_data=4),
-                       InlineKeyboardButton("5", callback_data=5)],
-                      [InlineKeyboardButton("2", callback_data=2),
-                       InlineKeyboardButton("3", callback_data=3)]]
-    reply_markup = InlineKeyboardMarkup(ratio_keyboard)
     query.edit_message_text(f"selected {tx_id}")
-    query.message.reply_text("Chose a ratio to split:", reply_markup=reply_markup)
+    query.message.reply_text("Chose a ratio to split:", reply_markup=get_ratio_keyboard())
     return SPLIT
 
 
+def get_ratio_keyboard(specify_amount=True):
+    ratio_keyboard = [[InlineKeyboardButton("specify amount", callback_data=0)]] if specify_amount else []
+    ratio_keyboard += [[InlineKeyboardButton("4", callback_data=4),
+                        InlineKeyboardButton("5", callback_data=5)],
+                       [InlineKeyboardButton("2", callback_data=2),
+                        InlineKeyboardButton("3", callback_data=3)]]
+    return InlineKeyboardMarkup(ratio_keyboard)
+
+
 def split_transaction(update: Update, context: CallbackContext) -> None:
-    firefly = get_firefly(context)
+    firefly = get_async_firefly(context)
     query = update.callback_query
     query.answer()
     tx_id = int(context.user_data.get("split_tx_id"))
-    ratio = float(query.data)
+    ratio = Decimal(query.data)
+    if ratio < 2:
+        query.edit_message_text("Splitting by an amount is not supported yet, please pick a ratio")
+        return SPLIT
+
+    tx = transaction_mirror.get(firefly.cache_key, tx_id) or run_coroutine(firefly.load_transaction(tx_id))
+    query.edit_message_text(text=f"Split tx '{tx.split.description}'")
+    result = run_coroutine(firefly.split_transaction(tx, ratio))
+    if result.tx_id:
+        query.message.reply_text(f"Updated transaction {tx_id} and created transaction {result.tx_id}")
+    else:
+        query.message.reply_text(f"Could not split transaction {tx_id}: {result.error}")
+    return ConversationHandler.END
 
-    tx = firefly.get_transaction(tx_id).get("data")
 
-    # calculate reduced amount for the existing expense tx
-    amount = float(tx.get("attributes").get("transactions")[0].get("amount"))
-    new_amount = amount / ratio
+def start_batch_split(update, context):
+    """`/splitmany` picks the expenses from a list, `/splitmany <ratio> <id> <id>...` splits right away"""
+    if context.args:
+        try:
+            ratio = Decimal(context.args[0])
+            tx_ids = list(dict.fromkeys(str(int(arg)) for arg in context.args[1:]))
+            valid = bool(tx_ids) and ratio.is_finite() and ratio >= 2
+        except (InvalidOperation, ValueError):
+            valid = False
+        if not valid:
+            update.message.reply_text("Usage: /splitmany <ratio> <transaction id> <transaction id>...")
+        elif len(tx_ids) > BATCH_SPLIT_MAX:
+            update.message.reply_text(f"At most {BATCH_SPLIT_MAX} transactions can be split at once")
+        else:
+            update.message.reply_text(split_batch(context, tx_ids, ratio))
+        return ConversationHandler.END
+
+    context.user_data["split_batch"] = []
+    reply_markup = get_batch_keyboard(get_firefly(context), [])
+    update.message.reply_text("Pick the transactions to split, then press Done", reply_markup=reply_markup)
+    return BATCH_SELECT
+
+
+def toggle_batch_tx(update, context):
+    query = update.callback_query
+    _, tx_id, offset = query.data.split(":")
+    selected = context.user_data.setdefault("split_batch", [])
+    if tx_id in selected:
+        selected.remove(tx_id)
+    elif len(selected) >= BATCH_SPLIT_MAX:
+        query.answer(f"At most {BATCH_SPLIT_MAX} transactions can be split at once")
+        return BATCH_SELECT
+    else:
+        selected.append(tx_id)
+    query.answer()
+    query.edit_message_reply_markup(reply_markup=get_batch_keyboard(get_firefly(context), selected, int(offset)))
+    return BATCH_SELECT
 
-    # create a new tx that transfers the reduced amound to the split balance account
-    balance_tx = tx.get("attributes").get("transactions")[0]
-    balance_tx_destination_name = "Splid Balance"
-    balance_tx_source = balance_tx["source_id"]
-    balance_tx_amount = float(balance_tx["amount"]) - new_amount
-    balance_tx_category = balance_tx["category_id"]
-    balance_tx_budget = balance_tx["budget_id"]
-    balance_tx_description = "[Split] - " + balance_tx["description"]
-    balance_tx_date = balance_tx["date"]
-    query.edit_message_text(text=f"Split tx '{balance_tx['description']}'")
 
-    try:
-        response = firefly.update_transaction(tx_id, amount=new_amount, description=balance_tx_description)
-        response_create = firefly.create_transaction(
-            type="transfer",
-            amount=balance_tx_amount,
-            description=balance_tx_description,
-            source_id=balance_tx_source,
-            destination_name=balance_tx_destination_name,
-            category_id=balance_tx_category,
-            budget_id=balance_tx_budget,
-            date=balance_tx_date
-        )
-        tx_id = response.json().get("data").get("id")
-        id_create = response_create.json().get("data").get("id")
-        query.message.reply_text(
-            f"Update transaction {tx_id}") if response.status_code == 200 else query.message.reply_text(
-            f"Error in update {response.status_code}")
-        query.message.reply_text(
-            f"Created transaction {id_create}") if response_create.status_code == 200 else query.message.reply_text(
-            f"Error in creation {response_create.status_code}")
-    except:
-        query.message.reply_text("Something went wrong")
+def select_batch_ratio(update, context):
+    query = update.callback_query
+    selected = context.user_data.get("split_batch", [])
+    if not selected:
+        query.answer("Pick at least one transaction")
+        return BATCH_SELECT
+    query.answer()
+    query.edit_message_text(f"{len(selected)} transactions selected")
+    query.message.reply_text("Chose a ratio to split:", reply_markup=get_ratio_keyboard(specify_amount=False))
+    return BATCH_RATIO
+
+
+def split_selected(update, context):
+    query = update.callback_query
+    query.answer()
+    tx_ids = context.user_data.pop("split_batch", [])
+    ratio = Decimal(query.data)
+    query.edit_message_text(f"Splitting {len(tx_ids)} transactions by {ratio}")
+    query.message.reply_text(split_batch(context, tx_ids, ratio))
     return ConversationHandler.END
 
 
+def split_batch(context, tx_ids, ratio):
+    """Split expenses at once, with a bounded number in flight, and sum up the outcome in one message"""
+    firefly = get_async_firefly(context)
+    # an expense listed twice would be split twice
+    tx_ids = list(dict.fromkeys(tx_ids))
+    transactions = {tx_id: transaction_mirror.get(firefly.cache_key, tx_id) for tx_id in tx_ids}
+    missing = [tx_id for tx_id, tx in transactions.items() if tx is None]
+    if missing:
+        loaded = run_concurrently(*(firefly.load_transaction(tx_id) for tx_id in missing))
+        transactions.update(zip(missing, loaded))
+
+    failures = []
+    splittable = []
+    for tx_id in tx_ids:
+        tx = transactions[tx_id]
+        if tx is None:
+            failures.append(f"{tx_id}: not found")
+        elif tx.split.type != "withdrawal":
+            failures.append(f"{tx_id}: not an expense")
+        else:
+            splittable.append(tx)
+    results = run_coroutine(firefly.split_transactions(splittable, ratio, concurrency=BATCH_SPLIT_CONCURRENCY))
+    failures.extend(f"{splittable[result.index].id}: {result.error}" for result in results if not result.tx_id)
+
+    message = f"Split {len(tx_ids) - len(failures)} of {len(tx_ids)} transactions by {ratio}"
+    if failures:
+        message += ", failed:\n" + "\n".join(failures[:REPORTED_FAILURES])
+        if len(failures) > REPORTED_FAILURES:
+            message += "\n..."
+    return message
+
+
+def load_balances(context):
+    """Every active asset account with its balance, from one listing of the accounts"""
+    firefly = get_firefly(context)
+    accounts = [a for a in firefly.iter_accounts(account_type="asset") if a.active]
+    missing = [a for a in accounts if a.current_balance is None]
+    if missing:
+        # the listing doesn't carry every balance, ask for those accounts one by one
+        async_firefly = get_async_firefly(context)
+        loaded = run_concurrently(*(async_firefly.load_account(a.id) for a in missing))
+        loaded = {a.id: a for a in loaded if a is not None}
+        accounts = [loaded.get(a.id, a) for a in accounts]
+    return accounts
+
+
+def format_balances(accounts):
+    lines = []
+    totals = {}
+    for account in accounts:
+        if account.current_balance is None:
+            lines.append(f"{account.name}: unknown")
+            continue
+        lines.append(f"{account.name}: {account.currency_code} {account.current_balance}")
+        totals[account.currency_code] = totals.get(account.currency_code, 0) + account.current_balance
+    if not lines:
+        return "You have no active asset accounts"
+    lines.append("")
+    lines.extend(f"Total {currency}: {total}" for currency, total in sorted(totals.items(), key=lambda item: str(item[0])))
+    return "\n".join(lines)
+
+
 def show_balance(update: Update, context: CallbackContext) -> None:
     query = update.callback_query
     query.answer()
-    asset_account = json.loads(query.data)
+    asset_account = resolve_button(query)
+    if asset_account is None:
+        return ConversationHandler.END
     firefly = get_firefly(context)
-    account = firefly.get_account(asset_account['id']).get("data")
-    account_name = account.get("attributes").get("name")
-    balance = account.get("attributes").get("current_balance")
-    curr = account.get("attributes").get("currency_code")
-    query.edit_message_text(text=f"The balance of {account_name} is {curr} {balance}")
+    account = firefly.load_account(asset_account['id'])
+    query.edit_message_text(text=f"The balance of {account.name} is {account.currency_code} {account.current_balance}")
     return ConversationHandler.END
 
 
@@ -328,34 +565,20 @@ def get_expense_account(update, context):
     # store the descriiption
     context.user_data["description"] = update.message.text
     # check if rule exists
-    rules = firefly.get_rules().get("data")
-
-    matched_rules = []
-
-    for rule in rules:
-        rule_title = rule.get("attributes").get("title")
-        rule_triggers = rule.get("attributes").get("triggers")
-        rule_actions = [action.get("type") for action in rule.get("attributes").get("actions")]
-        for trigger in rule_triggers:
-            if (trigger.get("type") == "description_contains"
-                    and trigger.get("value").lower() in update.message.text.lower()
-                    and 'set_source_account' in rule_actions
-                    and 'set_destination_account' in rule_actions):
-                matched_rules.append(rule)
+    matcher = get_rule_matcher(firefly.cache_key, firefly.list_rules())
+    matched_rules = matcher.match(update.message.text)
 
     if len(matched_rules) == 1:
         rule = matched_rules[0]
-        triggers = rule.get("attributes").get("triggers")
-        title = rule.get("attributes").get("title")
         further_cond = []
-        for trigger in triggers:
-            if trigger.get("type") != "description_contains":
-                further_cond.append(f"{trigger.get('type')}: {trigger.get('value')}")
+        for trigger_type, value in rule.triggers:
+            if trigger_type != "description_contains":
+                further_cond.append(f"{trigger_type}: {value}")
 
         context.user_data["asset_account"] = dict(id="1", name="Credit Suisse")
         context.user_data["expense_account"] = "dummy"
 
-        update.message.reply_markdown(f"*{title}*\nPlease enter amount:")
+        update.message.reply_markdown(f"*{rule.title}*\nPlease enter amount:")
         return AMOUNT
     else:
         reply_markup = get_default_asset_keyboard(firefly)
@@ -367,24 +590,30 @@ def get_expense_account(update, context):
 def get_withdraw_account(update: Update, context: CallbackContext) -> None:
     query = update.callback_query
     query.answer()
-    context.user_data["asset_account"] = json.loads(query.data)
-
-    firefly = get_firefly(context)
-    accounts = firefly.get_accounts(account_type="expense").get("data")
-    accounts_keyboard = []
-    accounts = [a for a in accounts if a.get("attributes").get("active")]
-    for i, account in enumerate(accounts):
-        if i % 3 == 0:
-            accounts_keyboard.append([])
-        account_name = account.get("attributes").get("name")
-        accounts_keyboard[-1].append(account_name)
+    asset_account = resolve_button(query)
+    if asset_account is None:
+        return ConversationHandler.END
+    context.user_data["asset_account"] = asset_account
+
+    # picking from thousands of payees is left to inline queries, see search_expense_accounts
+    markup = InlineKeyboardMarkup([[InlineKeyboardButton("Search expense accounts",
+                                                         switch_inline_query_current_chat="")]])
+    query.edit_message_text(asset_account["name"])
+    query.message.reply_text("Type the expense account or search for it", reply_markup=markup)
+    return DEST
 
-    markup = ReplyKeyboardMarkup(accounts_keyboard, one_time_keyboard=True)
 
-    # update.send_message("Chose an expense account:", reply_markup=markup)
-    query.edit_message_text(query.data)
-    query.message.reply_text("Chose an expense account", reply_markup=markup)
-    return DEST
+def search_expense_accounts(update, context):
+    query = update.inline_query
+    if not context.user_data.get("firefly_token"):
+        query.answer([], switch_pm_text="Set up the bot first", switch_pm_parameter="setup")
+        return
+    firefly = get_firefly(context)
+    index = get_account_index(firefly.cache_key, firefly.list_accounts(account_type="expense"))
+    results = [InlineQueryResultArticle(id=account.id, title=account.name,
+                                        input_message_content=InputTextMessageContent(account.name))
+               for account in index.search(query.query, limit=INLINE_RESULTS)]
+    query.answer(results, cache_time=0, is_personal=True)
 
 
 def get_amount(update, context):
@@ -402,23 +631,129 @@ def summarize(update, context):
     update.message.reply_text(
         f"Withdraw from {asset_account['name']} to {expense_account}, amount {update.message.text}, description: {description}")
 
+    payload = withdrawal_payload(update.message.text, description, asset_account['id'], expense_account)
+    outbox.enqueue(update.effective_chat.id, context.user_data.get("firefly_url"),
+                   context.user_data.get("firefly_token"), payload)
+    outbox_worker.wake()
+    update.message.reply_text("Expense queued, I'll let you know once Firefly has it.")
+
+    return ConversationHandler.END
+
+
+def spend(update, context):
+    default_account = context.user_data.get("firefly_default_account")
+    if not default_account:
+        update.message.reply_text("Type /start to initiate the setup process.")
+        return
+    try:
+        expense = parse_expense(update.message.text)
+    except ExpenseError as e:
+        update.message.reply_text(str(e))
+        return
+
+    # only the indexes of fields given by name are needed, they are usually cached
+    firefly = get_async_firefly(context)
+    lookups = {}
+    if needs_lookup(expense.source):
+        lookups["assets"] = firefly.account_names("asset")
+    if needs_lookup(expense.destination or expense.description):
+        lookups["expenses"] = firefly.account_names("expense")
+    if expense.category:
+        lookups["categories"] = firefly.category_names()
+    if needs_lookup(expense.budget):
+        lookups["budgets"] = firefly.budget_names()
+    indexes = dict(zip(lookups, run_concurrently(*lookups.values())))
+    try:
+        payload = expense_payload(expense, default_account, **indexes)
+    except ExpenseError as e:
+        update.message.reply_text(str(e))
+        return
+
+    outbox.enqueue(update.effective_chat.id, context.user_data.get("firefly_url"),
+                   context.user_data.get("firefly_token"), payload)
+    outbox_worker.wake()
+    update.message.reply_text(f"Expense '{expense.description}' ({expense.amount}) queued, "
+                              f"I'll let you know once Firefly has it.")
+
+
+def show_report(update, context):
+    try:
+        first, last = parse_months(context.args)
+    except ReportError as e:
+        update.message.reply_text(str(e))
+        return
     firefly = get_firefly(context)
-    response = firefly.create_withdrawal(update.message.text, description,
-                                         asset_account['id'], expense_account)
-    if response.status_code == 422:
-        update.message.reply_text(response.get("message"))
-    elif response.status_code == 200:
-        try:
-            tx_id = response.json().get("data").get("id")
-            firefly_url = context.user_data.get("firefly_url")
-            update.message.reply_text(
-                f"Expense logged successfully. Use /list {tx_id} to see details."
-                )
-        except:
-            update.message.reply_text("Please check input values")
-    else:
-        update.message.reply_text("Something went wrong, check logs")
+    stale = not transaction_mirror.refresh(firefly)
+    text = format_report(build_report(transaction_mirror, firefly.cache_key, first, last), first, last)
+    if stale:
+        text += "\n\nFirefly could not be reached, recent changes may be missing."
+    update.message.reply_text(text)
+
+
+def show_outbox(update, context):
+    entries = outbox.pending(update.effective_chat.id)
+    if not entries:
+        update.message.reply_text("All expenses have been delivered to Firefly.")
+        return
+    lines = []
+    for entry in entries:
+        tx = entry.payload["transactions"][0]
+        error = f" - last error: {entry.last_error}" if entry.last_error else ""
+        lines.append(f"{tx['description']} ({tx['amount']}), {entry.attempts} attempts{error}")
+    update.message.reply_text("Waiting for delivery:\n" + "\n".join(lines))
+
+
+def start_import(update, context):
+    if not context.user_data.get("firefly_default_account"):
+        update.message.reply_text("Type /start to initiate the setup process.")
+        return ConversationHandler.END
+    update.message.reply_markdown("""
+Send me your statement as a CSV file. The first row must name the columns -
+`date, amount, description` are required, `category, budget, source, destination, notes, group` are optional.
+
+Negative amounts are withdrawals from your default account, positive ones deposits into it.
+""")
+    return UPLOAD_STATEMENT
 
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def import_statement(update, context):
+    buffer = io.BytesIO()
+    update.message.document.get_file().download(out=buffer)
+
+    firefly = get_async_firefly(context)
+    default_account = context.user_data.get("firefly_default_account")
+    imported = 0
+    failures = []
+    try:
+        lines = io.StringIO(decode_statement(buffer.getvalue()), newline="")
+        for batch in chunked(read_statement(lines, default_account), IMPORT_BATCH_SIZE):
+            failures.extend(f"line {line}: {error}" for line, payload, error in batch if error)
+            rows = [(line, payload) for line, payload, error in batch if payload]
+            results = run_coroutine(firefly.create_transactions([payload for line, payload in rows]))
+            for result in results:
+                if result.tx_id:
+                    imported += 1
+                else:
+                    failures.append(f"line {rows[result.index][0]}: {result.error}")
+    except StatementError as e:
+        update.message.reply_text(f"Cannot read the statement: {e}")
+        return ConversationHandler.END
+
+    message = f"Imported {imported} transactions"
+    if failures:
+        message += f", {len(failures)} failed:\n" + "\n".join(failures[:REPORTED_FAILURES])
+        if len(failures) > REPORTED_FAILURES:
+            message += "\n..."
+    update.message.reply_text(message)
     return ConversationHandler.END
 
 
@@ -427,23 +762,73 @@ def cancel(update, context):
     return ConversationHandler.END
 
 
+def log_stats(context):
+    logger.info("Reference cache stats: %s", reference_cache.stats())
+    logger.info("Handler lane stats: %s", context.dispatcher.lanes.stats(reset=True))
+    logger.info("Firefly request rates: %s", host_limiter.stats())
+    if warmup is not None:
+        logger.info("Warm-up stats: %s", warmup.stats(reset=True))
+    logger.info("Timings: %s", json.dumps(metrics.summary()))
+
+
 def error(update, context):
     """Log Errors caused by Updates."""
     logger.warning("Update '%s' caused error '%s'", update, context.error)
 
 
-def main():
-    data_dir = os.getenv("CONFIG_PATH", "")
-    if not data_dir:
-        data_dir = Path.joinpath(Path.home(), ".config", "firefly-bot")
-        data_dir.mkdir(parents=True, exist_ok=True)
-    else:
-        data_dir = Path(data_dir)
-    bot_persistence = PicklePersistence(filename=str(data_dir / "bot-data"))
-    bot_token = os.getenv("TELEGRAM_BOT_TOKEN")
-    updater = Updater(bot_token,
-                      persistence=bot_persistence, use_context=True)
-
+def create_updater(bot_token, persistence, bot_class=Bot):
+    workers = int(os.getenv("BOT_WORKERS", 4))
+    lanes = UserLanes(workers=int(os.getenv("HANDLER_WORKERS", 8)),
+                      max_pending=int(os.getenv("HANDLER_MAX_PENDING", 1000)))
+    # only the webhook listener can push back on a full queue, polling would lose updates
+    queue_size = int(os.getenv("UPDATE_QUEUE_SIZE", 0)) if os.getenv("WEBHOOK_URL") else 0
+    bot = bot_class(bot_token, request=Request(con_pool_size=workers + lanes.workers + 4))
+    job_queue = JobQueue()
+    dispatcher = LaneDispatcher(bot, UpdateQueue(maxsize=queue_size), workers=workers, job_queue=job_queue,
+                                persistence=persistence, use_context=True, lanes=lanes)
+    job_queue.set_dispatcher(dispatcher)
+    return Updater(dispatcher=dispatcher, workers=None, use_context=True)
+
+
+def start_updater(updater):
+    """Long poll Telegram, or listen for webhook calls behind a reverse proxy if WEBHOOK_URL is set"""
+    webhook_url = os.getenv("WEBHOOK_URL")
+    if not webhook_url:
+        updater.start_polling()
+        return
+    url_path = os.getenv("WEBHOOK_PATH", updater.bot.token)
+    updater.start_webhook(listen=os.getenv("WEBHOOK_LISTEN", "0.0.0.0"),
+                          port=int(os.getenv("WEBHOOK_PORT", 8443)),
+                          url_path=url_path)
+    updater.bot.set_webhook(url=f"{webhook_url.rstrip('/')}/{url_path}")
+
+
+def migrate_persistence(data_dir):
+    """Move the state of older versions from the pickle file into SQLite, once"""
+    db_file = data_dir / "bot-data.sqlite"
+    pickle_file = data_dir / "bot-data"
+    if pickle_file.exists() and not db_file.exists():
+        migrating_file = data_dir / "bot-data.sqlite.migrating"
+        migrate_pickle(pickle_file, migrating_file)
+        migrating_file.rename(db_file)
+        pickle_file.rename(data_dir / "bot-data.migrated")
+        logger.info("Migrated %s to %s", pickle_file, db_file)
+    return db_file
+
+
+def instrument(handler):
+    """Time the callbacks of a handler, including every handler of a conversation"""
+    if isinstance(handler, ConversationHandler):
+        for nested in handler.entry_points + handler.fallbacks:
+            instrument(nested)
+        for state_handlers in handler.states.values():
+            for nested in state_handlers:
+                instrument(nested)
+    elif not hasattr(handler.callback, "__wrapped__"):
+        handler.callback = metrics.timed(handler.callback.__name__, handler.callback)
+
+
+def add_handlers(dispatcher):
     conversation_handler = ConversationHandler(
         entry_points=[CommandHandler("start", start)],
         states={
@@ -458,7 +843,8 @@ def main():
         entry_points=[CommandHandler("expense", start_expense)],
         states={
             DESCRIPTION: [MessageHandler(Filters.text, get_expense_account)],
-            SOURCE: [CallbackQueryHandler(get_withdraw_account)],
+            SOURCE: [CallbackQueryHandler(turn_page, pattern="^page:"),
+                     CallbackQueryHandler(get_withdraw_account)],
             DEST: [MessageHandler(Filters.text, get_amount)],
             AMOUNT: [MessageHandler(Filters.text, summarize)]
         },
@@ -467,7 +853,8 @@ def main():
     balance = ConversationHandler(
         entry_points=[CommandHandler("balance", get_balance)],
         states={
-            0: [CallbackQueryHandler(show_balance)],
+            0: [CallbackQueryHandler(turn_page, pattern="^page:"),
+                CallbackQueryHandler(show_balance)],
         },
         fallbacks=[CommandHandler("cancel", cancel)]
     )
@@ -475,9 +862,21 @@ def main():
     split = ConversationHandler(
         entry_points=[CommandHandler("split", start_split)],
         states={
-            SELECT: [CallbackQueryHandler(select_ratio)],
+            SELECT: [CallbackQueryHandler(turn_page, pattern="^page:"),
+                     CallbackQueryHandler(select_ratio)],
             SPLIT: [CallbackQueryHandler(split_transaction)],
-            SET_SPLIT_ACCOUNT: [CallbackQueryHandler(store_split_account)],
+            SET_SPLIT_ACCOUNT: [CallbackQueryHandler(turn_page, pattern="^page:"),
+                                CallbackQueryHandler(store_split_account)],
+        },
+        fallbacks=[CommandHandler("cancel", cancel)]
+    )
+    batch_split = ConversationHandler(
+        entry_points=[CommandHandler("splitmany", start_batch_split)],
+        states={
+            BATCH_SELECT: [CallbackQueryHandler(turn_page, pattern="^page:"),
+                           CallbackQueryHandler(select_batch_ratio, pattern="^pick:done$"),
+                           CallbackQueryHandler(toggle_batch_tx, pattern="^pick:")],
+            BATCH_RATIO: [CallbackQueryHandler(split_selected, pattern="^[0-9]+$")],
         },
         fallbacks=[CommandHandler("cancel", cancel)]
     )
@@ -485,10 +884,12 @@ def main():
         entry_points=[
             # RegexHandler('^\/list\s\d+$', show_individual),
             # CommandHandler("list", show_individual, filters=Filters.regex("^[a-zA-Z]+\s\d+$")),
-            CommandHandler("list", show_tx)
+            CommandHandler("list", show_tx),
+            CommandHandler("search", search_tx),
         ],
         states={
-            SHOW: [CallbackQueryHandler(show_details)],
+            SHOW: [CallbackQueryHandler(turn_page, pattern="^page:"),
+                   CallbackQueryHandler(show_details)],
             DETAILS: [
                 CallbackQueryHandler(delete_tx, pattern="^\d+$"),
                 CallbackQueryHandler(cancel_details, pattern='^' + 'cancel' + '$'),
@@ -497,24 +898,147 @@ def main():
         },
         fallbacks=[CommandHandler("cancel", cancel)]
     )
-    updater.dispatcher.add_handler(expense)
-    updater.dispatcher.add_handler(balance)
-    updater.dispatcher.add_handler(split)
-    updater.dispatcher.add_handler(list)
-    updater.dispatcher.add_handler(CommandHandler("help", show_help))
-    updater.dispatcher.add_handler(CommandHandler("about", about))
-
-    # updater.dispatcher.add_handler(MessageHandler(
-    #    filters=Filters.regex("^[0-9]+"), callback=spend))
-    updater.dispatcher.add_error_handler(error)
-    updater.dispatcher.add_handler(conversation_handler)
+    statement_import = ConversationHandler(
+        entry_points=[CommandHandler("import", start_import)],
+        states={
+            UPLOAD_STATEMENT: [MessageHandler(Filters.document, import_statement)],
+        },
+        fallbacks=[CommandHandler("cancel", cancel)]
+    )
+    dispatcher.add_handler(expense)
+    dispatcher.add_handler(balance)
+    dispatcher.add_handler(split)
+    dispatcher.add_handler(batch_split)
+    dispatcher.add_handler(list)
+    dispatcher.add_handler(statement_import)
+    dispatcher.add_handler(CommandHandler("help", show_help))
+    dispatcher.add_handler(CommandHandler("about", about))
+    dispatcher.add_handler(CommandHandler("outbox", show_outbox))
+    dispatcher.add_handler(CommandHandler("report", show_report))
+    dispatcher.add_handler(InlineQueryHandler(search_expense_accounts))
+
+    dispatcher.add_error_handler(error)
+    dispatcher.add_handler(conversation_handler)
+    # one line expenses, messages that belong to a conversation never get here
+    dispatcher.add_handler(MessageHandler(Filters.text & Filters.regex(r"^\s*[0-9]"), spend))
+
+    for handlers in dispatcher.handlers.values():
+        for handler in handlers:
+            instrument(handler)
+
+
+def data_directory():
+    data_dir = os.getenv("CONFIG_PATH", "")
+    if not data_dir:
+        data_dir = Path.joinpath(Path.home(), ".config", "firefly-bot")
+        data_dir.mkdir(parents=True, exist_ok=True)
+    else:
+        data_dir = Path(data_dir)
+    return data_dir
+
+
+def setup(updater, bot_persistence, data_dir, shard=None):
+    """
+    Everything but receiving updates. `shard` is (index, count) in a worker process,
+    the worker then only delivers and warms up what belongs to its users.
+    """
+    global outbox, outbox_worker, transaction_mirror, warmup
+    # a rate of 0 turns the limit off
+    host_limiter.configure(float(os.getenv("FIREFLY_RATE_LIMIT", DEFAULT_RATE)) or None,
+                           int(os.getenv("FIREFLY_BURST", DEFAULT_BURST)))
+    transaction_mirror = TransactionMirror(data_dir / "transactions.sqlite",
+                                           sync_interval=int(os.getenv("MIRROR_SYNC_INTERVAL", 60)),
+                                           reconcile_interval=int(os.getenv("MIRROR_RECONCILE_INTERVAL", 24 * 3600)))
+    outbox = Outbox(data_dir / "outbox.sqlite")
+    outbox_worker = OutboxWorker(outbox, notify=updater.bot.send_message, cache=reference_cache,
+                                 mirror=transaction_mirror, poll_interval=int(os.getenv("OUTBOX_POLL_INTERVAL", 5)),
+                                 shard=shard)
+    outbox_worker.start()
+
+    add_handlers(updater.dispatcher)
+    warmup_interval = int(os.getenv("WARMUP_INTERVAL", 240))
+    if warmup_interval:
+        warmup = Warmup(bot_persistence, warm_up, interval=warmup_interval,
+                        active_window=int(os.getenv("WARMUP_ACTIVE_DAYS", 7)) * 24 * 3600, shard=shard)
+        updater.dispatcher.add_handler(TypeHandler(Update, warmup.touch), group=-1)
+        warmup.start(updater.dispatcher)
+    metrics.register_gauges("bot_reference_cache", reference_cache.stats)
+    metrics.register_gauges("bot_callback_tokens", callback_tokens.stats)
+    metrics.register_gauges("bot_handler_lanes", updater.dispatcher.lanes.stats)
+    if os.getenv("METRICS_PORT"):
+        # every worker process serves its own metrics, on the ports following METRICS_PORT
+        port = int(os.getenv("METRICS_PORT")) + (shard[0] if shard else 0)
+        metrics.start_http_server(port, os.getenv("METRICS_LISTEN", "0.0.0.0"))
+    updater.job_queue.run_repeating(log_stats, interval=int(os.getenv("STATS_INTERVAL", 600)))
+
+
+def shutdown():
+    if warmup is not None:
+        warmup.stop()
+    outbox_worker.stop()
+    outbox.close()
+    transaction_mirror.close()
+
+
+def run_worker(index, count, updates):
+    """Worker process of the multi-process mode, handles the updates routed to it by the front end"""
+    data_dir = data_directory()
+    bot_persistence = SQLitePersistence(filename=data_dir / "bot-data.sqlite")
+    updater = create_updater(os.getenv("TELEGRAM_BOT_TOKEN"), bot_persistence)
+    setup(updater, bot_persistence, data_dir, shard=(index, count))
+    logger.info("Worker %s of %s started", index, count)
+    feed(updater, updates)
+    shutdown()
+    bot_persistence.close()
+
+
+def run_front_end(processes):
+    """Receive updates and route them to `processes` worker processes by user"""
+    migrate_persistence(data_directory())
+    # only the webhook listener can push back on a full queue, polling would lose updates
+    queue_size = int(os.getenv("UPDATE_QUEUE_SIZE", 0)) if os.getenv("WEBHOOK_URL") else 0
+    # a full worker queue holds up the front end, whose queue then pushes back in turn
+    workers = Workers(run_worker, processes, maxsize=queue_size)
+    workers.start()
+    crashed = []
+
+    def worker_exited(process):
+        # without the worker its users get no answers, stop so a supervisor can restart the bot
+        logger.error("Worker %s exited with code %s, stopping", process.name, process.exitcode)
+        crashed.append(process)
+        os.kill(os.getpid(), signal.SIGTERM)
+
+    workers.watch(worker_exited)
+    bot = Bot(os.getenv("TELEGRAM_BOT_TOKEN"), request=Request(con_pool_size=8))
+    router = ShardRouter(bot, UpdateQueue(maxsize=queue_size), workers)
+    updater = Updater(dispatcher=router, workers=None, use_context=True)
+    start_updater(updater)
+    updater.idle()
+    logger.info("Updates routed per worker: %s", router.stats())
+    workers.stop()
+    if crashed:
+        sys.exit(1)
+
+
+def main():
+    processes = int(os.getenv("BOT_PROCESSES", 1))
+    if processes > 1:
+        run_front_end(processes)
+        return
+
+    data_dir = data_directory()
+    bot_persistence = SQLitePersistence(filename=migrate_persistence(data_dir))
+    bot_token = os.getenv("TELEGRAM_BOT_TOKEN")
+    updater = create_updater(bot_token, bot_persistence)
+    setup(updater, bot_persistence, data_dir)
 
     # Start the Bot
-    updater.start_polling()
+    start_updater(updater)
 
     # Run the bot until the user presses Ctrl-C or the process receives SIGINT,
     # SIGTERM or SIGABRT
     updater.idle()
+    shutdown()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,66 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache(object):
+    """
+    Thread safe LRU cache whose entries expire after `ttl` seconds. It is shared by
+    all users, so the least recently used entries get evicted across users once
+    `maxsize` is reached.
+    """
+
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None, min_ttl=0):
+        """`min_ttl` treats entries expiring within that many seconds as missing"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                expires, value = entry
+                now = time.monotonic()
+                if expires > now + min_ttl:
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                if expires <= now:
+                    del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_load(self, key, loader, min_ttl=0):
+        missing = object()
+        value = self.get(key, missing, min_ttl)
+        if value is missing:
+            value = loader()
+            self.set(key, value)
+        return value
+
+    def invalidate(self, predicate):
+        with self._lock:
+            for key in [k for k in self._data if predicate(k)]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            return dict(size=len(self._data), maxsize=self.maxsize, ttl=self.ttl,
+                        hits=self.hits, misses=self.misses, evictions=self.evictions)
@@ -0,0 +1,134 @@
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from queue import Queue
+
+from telegram import Update
+from telegram.ext import Dispatcher
+
+logger = logging.getLogger(__name__)
+
+
+class UpdateQueue(Queue):
+    """
+    Update queue of the dispatcher with an optional bound. When it is full, the webhook
+    listener gives up after `put_timeout` seconds and answers with an error, so
+    Telegram delivers the update again later instead of the listener stalling.
+    """
+
+    def __init__(self, maxsize=0, put_timeout=1.0):
+        super().__init__(maxsize=maxsize)
+        self.put_timeout = put_timeout
+
+    def put(self, item, block=True, timeout=None):
+        if block and timeout is None and self.maxsize > 0:
+            timeout = self.put_timeout
+        super().put(item, block=block, timeout=timeout)
+
+
+class UserLanes(object):
+    """
+    Runs tasks on a bounded thread pool while keeping the tasks of one key in order.
+    Each key has its own lane, and at most one task per lane runs at any time. After
+    each task the lane goes to the back of the pool's queue, so a busy user cannot
+    starve the others. `submit` blocks once `max_pending` tasks are waiting.
+    """
+
+    def __init__(self, workers=8, max_pending=1000):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="lane")
+        self._lanes = {}
+        self._lock = threading.Lock()
+        self._capacity = threading.BoundedSemaphore(max_pending)
+        self.workers = workers
+        self.max_pending = max_pending
+        self.pending = 0
+        self.processed = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def submit(self, key, task):
+        self._capacity.acquire()
+        with self._lock:
+            self.pending += 1
+            lane = self._lanes.get(key)
+            idle = lane is None
+            if idle:
+                lane = self._lanes[key] = deque()
+            lane.append((time.monotonic(), task))
+        if idle:
+            self._executor.submit(self._run_next, key)
+
+    def _run_next(self, key):
+        with self._lock:
+            enqueued, task = self._lanes[key].popleft()
+            self.pending -= 1
+            wait = time.monotonic() - enqueued
+            self.processed += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+        try:
+            task()
+        except Exception:
+            logger.exception("Task for %s failed", key)
+        finally:
+            self._capacity.release()
+            with self._lock:
+                if self._lanes[key]:
+                    self._executor.submit(self._run_next, key)
+                else:
+                    del self._lanes[key]
+
+    def stats(self, reset=False):
+        """Queue depth and how long tasks waited for a worker, in milliseconds"""
+        with self._lock:
+            stats = dict(pending=self.pending, lanes=len(self._lanes), workers=self.workers,
+                         processed=self.processed, wait_max_ms=self.wait_max * 1000,
+                         wait_avg_ms=self.wait_total / self.processed * 1000 if self.processed else 0.0)
+            if reset:
+                self.processed, self.wait_total, self.wait_max = 0, 0.0, 0.0
+        return stats
+
+    def shutdown(self):
+        # lanes resubmit themselves, let them drain before the pool stops taking tasks
+        while True:
+            with self._lock:
+                if not self._lanes:
+                    break
+            time.sleep(0.05)
+        self._executor.shutdown(wait=True)
+
+
+def lane_key(update):
+    if not isinstance(update, Update):
+        return None
+    if update.effective_user:
+        return update.effective_user.id
+    if update.effective_chat:
+        return update.effective_chat.id
+    return None
+
+
+class LaneDispatcher(Dispatcher):
+    """
+    Dispatcher that handles updates on `UserLanes` instead of its own thread. A slow
+    Firefly instance then only holds up the updates of its own user, while each user's
+    updates, and with them the conversation states, are still handled in order.
+    """
+
+    def __init__(self, *args, lanes=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lanes = lanes or UserLanes()
+
+    def process_update(self, update):
+        key = lane_key(update)
+        if key is None:
+            super().process_update(update)
+        else:
+            self.lanes.submit(key, partial(super().process_update, update))
+
+    def stop(self):
+        super().stop()
+        self.lanes.shutdown()
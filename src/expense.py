@@ -0,0 +1,83 @@
+"""
+One message expenses in the format
+
+    Amount, Description, Category, Budget, Source account, Destination account
+
+Only amount and description are required, the description doubles as destination
+account. Accounts, categories and budgets are given by name or id. Names are looked
+up in the cached name indexes of the Firefly client, so the only request needed is
+the one creating the withdrawal.
+"""
+from collections import namedtuple
+from decimal import Decimal, InvalidOperation
+
+from firefly import transaction_payload
+
+FIELDS = ("amount", "description", "category", "budget", "source", "destination")
+
+Expense = namedtuple("Expense", FIELDS)
+
+
+class ExpenseError(ValueError):
+    pass
+
+
+def parse_expense(text):
+    values = [value.strip() for value in text.split(",")]
+    if len(values) < 2 or len(values) > len(FIELDS):
+        raise ExpenseError("Use the format: Amount, Description, Category, Budget, Source, Destination")
+    values += [""] * (len(FIELDS) - len(values))
+    try:
+        amount = Decimal(values[0])
+    except InvalidOperation:
+        raise ExpenseError(f"Invalid amount '{values[0]}'")
+    if not amount.is_finite() or amount <= 0:
+        raise ExpenseError(f"Invalid amount '{values[0]}'")
+    if not values[1]:
+        raise ExpenseError("The description is missing")
+    return Expense(amount, *(value or None for value in values[1:]))
+
+
+def needs_lookup(value):
+    return bool(value) and not value.isnumeric()
+
+
+def expense_payload(expense, default_account, assets=None, expenses=None, categories=None, budgets=None):
+    """
+    Build the withdrawal of a parsed expense. The name indexes map lower case names to
+    models and only have to be given for the fields that hold a name.
+    """
+    split = dict(type="withdrawal", amount=expense.amount, description=expense.description)
+
+    source = expense.source or default_account
+    if source.isnumeric():
+        split["source_id"] = source
+    elif source.lower() in assets:
+        split["source_id"] = assets[source.lower()].id
+    else:
+        raise ExpenseError(f"Unknown asset account '{source}'")
+
+    # unknown destinations and categories are created by Firefly
+    destination = expense.destination or expense.description
+    if destination.isnumeric():
+        split["destination_id"] = destination
+    elif destination.lower() in expenses:
+        split["destination_id"] = expenses[destination.lower()].id
+    else:
+        split["destination_name"] = destination
+
+    if expense.category:
+        if expense.category.lower() in categories:
+            split["category_id"] = categories[expense.category.lower()].id
+        else:
+            split["category_name"] = expense.category
+
+    if expense.budget:
+        if expense.budget.isnumeric():
+            split["budget_id"] = expense.budget
+        elif expense.budget.lower() in budgets:
+            split["budget_id"] = budgets[expense.budget.lower()].id
+        else:
+            raise ExpenseError(f"Unknown budget '{expense.budget}'")
+
+    return transaction_payload(**split)
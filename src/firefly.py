@@ -1,107 +1,460 @@
-import requests
 import datetime
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from decimal import Decimal
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import metrics
+from jsonstream import iter_members
+from models import Account, Budget, Category, Rule, Transaction
+from throttle import HostLimiter, SingleFlight, retry_after
 
 tx_attrs = ["type", "date", "amount", "description", "order", "currency_id", "currency_code", "foreign_amount",
-            "foreign_currency_id", "foreign_currency_code", "USD", "budget_id", "category_id", "category_name",
-            "source_id", "source_name", "destination_id", "destination_name", "reconciled", "piggy_bank_id",
-            "piggy_bank_name", "bill_id", "bill_name", "tags", "notes", "internal_reference", "external_id",
-            "bunq_payment_id", "sepa_cc", "sepa_ct_op", "sepa_ct_id", "sepa_db", "sepa_country", "sepa_ep", "sepa_ci",
-            "sepa_batch_id", "interest_date", "book_date", "process_date", "due_date", "payment_date", "invoice_date"]
+            "foreign_currency_id", "foreign_currency_code", "USD", "budget_id", "budget_name", "category_id",
+            "category_name", "source_id", "source_name", "destination_id", "destination_name", "reconciled",
+            "piggy_bank_id", "piggy_bank_name", "bill_id", "bill_name", "tags", "notes", "internal_reference",
+            "external_id", "bunq_payment_id", "sepa_cc", "sepa_ct_op", "sepa_ct_id", "sepa_db", "sepa_country",
+            "sepa_ep", "sepa_ci", "sepa_batch_id", "interest_date", "book_date", "process_date", "due_date",
+            "payment_date", "invoice_date"]
+TX_ATTRS = frozenset(tx_attrs)
+
+# (connect, read) timeouts in seconds, applied to every call
+DEFAULT_TIMEOUT = (3.05, 30)
+POOL_MAXSIZE = 10
+# parallel requests of a bulk submission, kept below the pool size
+BULK_CONCURRENCY = 8
+# destination of the transfers booking the other share of a split, existing ledgers use this name
+SPLIT_BALANCE_ACCOUNT = "Splid Balance"
+# streamed listings decode one item at a time, so they can ask for large pages
+STREAM_PAGE_SIZE = 500
+STREAM_CHUNK_SIZE = 64 * 1024
+# requests per second and burst allowed per Firefly host, see bot.main for the settings,
+# they also cap bulk writes like /import at about DEFAULT_RATE transactions per second
+DEFAULT_RATE = 20
+DEFAULT_BURST = 40
+# POST is left out on purpose, retrying it could create a transaction twice
+IDEMPOTENT_METHODS = frozenset(["GET", "HEAD", "OPTIONS", "PUT", "DELETE"])
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+# identical GETs in flight share one request
+_inflight = SingleFlight()
+host_limiter = HostLimiter(rate=DEFAULT_RATE, burst=DEFAULT_BURST)
+
+# fetches the next page of a listing while the caller consumes the current one
+_prefetch_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="firefly-prefetch")
+
+
+def get_session(hostname, auth_token):
+    """Return the shared keep-alive session for a Firefly instance and token."""
+    key = (hostname, auth_token)
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is None:
+            retry = Retry(total=3, backoff_factor=0.3, status_forcelist=(502, 503, 504),
+                          allowed_methods=IDEMPOTENT_METHODS, raise_on_status=False)
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_MAXSIZE, max_retries=retry)
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            session.headers.update({'Authorization': "Bearer " + auth_token})
+            _sessions[key] = session
+        return session
+
+
+def close_sessions():
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+
+
+# cached resources whose content changes when a transaction is written
+TX_DEPENDENT_RESOURCES = frozenset(["accounts", "budgets", "bills", "categories"])
+
 
 class Firefly(object):
-    def __init__(self, hostname, auth_token):
-        self.headers = {'Authorization': "Bearer " + auth_token}
+    def __init__(self, hostname, auth_token, timeout=DEFAULT_TIMEOUT, cache=None, mirror=None,
+                 min_ttl=0):
         self.hostname = hostname + "/api/v1/"
+        self.timeout = timeout
+        self.session = get_session(hostname, auth_token)
+        self.cache = cache
+        self.mirror = mirror
+        self.cache_key = (hostname, auth_token)
+        # cached listings expiring sooner than this are loaded again, see warmup.py
+        self.min_ttl = min_ttl
+        self.host = urlparse(hostname).netloc
+
+    def _request(self, method, endpoint, **kwargs):
+        url = self._url(endpoint)
+        delay = host_limiter.reserve(self.host)
+        if delay:
+            metrics.firefly_throttle_seconds.inc(delay)
+            time.sleep(delay)
+        start = time.perf_counter()
+        status, size, wait = "error", 0, None
+        try:
+            response = self.session.request(method, url, timeout=self.timeout, **kwargs)
+            if kwargs.get("stream"):
+                # reading the content here would defeat streaming, the timing ends with the headers
+                status, size = response.status_code, int(response.headers.get("Content-Length") or 0)
+            else:
+                status, size = response.status_code, len(response.content)
+            wait = retry_after(response.headers)
+            return response
+        finally:
+            host_limiter.feedback(self.host, status, wait)
+            metrics.record_request(method, url, status, time.perf_counter() - start, size)
 
     def _post(self, endpoint, payload):
-        return requests.post("{}{}".format(self.hostname, endpoint), json=payload, headers=self.headers)
+        return self._request("POST", endpoint, json=payload)
 
     def _put(self, endpoint, payload):
-        return requests.put("{}{}".format(self.hostname, endpoint), json=payload, headers=self.headers)
+        return self._request("PUT", endpoint, json=payload)
 
     def _delete(self, endpoint):
-        return requests.delete("{}{}".format(self.hostname, endpoint), headers=self.headers)
+        return self._request("DELETE", endpoint)
+
+    def _url(self, endpoint):
+        # pagination links are absolute URLs
+        if endpoint.startswith(("http://", "https://")):
+            return endpoint
+        return "{}{}".format(self.hostname, endpoint)
 
     def _get(self, endpoint, params=None):
-        response = requests.get("{}{}".format(
-            self.hostname, endpoint), params=params, headers=self.headers)
-        return response.json()
+        return self._get_json(endpoint, params)
+
+    def _get_page(self, endpoint, params=None):
+        # a failed page must not look like an empty listing
+        return self._get_json(endpoint, params, check=True)
+
+    def _get_json(self, endpoint, params=None, check=False):
+        """Decoded body of a GET, shared with identical calls in flight. It must not be modified"""
+        def fetch():
+            response = self._request("GET", endpoint, params=params)
+            if check:
+                response.raise_for_status()
+            return response.json()
+
+        url = self._url(endpoint)
+        key = (self.cache_key, url, tuple(sorted((params or {}).items())), check)
+        body, shared = _inflight.do(key, fetch)
+        if shared:
+            metrics.firefly_coalesced_requests.inc(1, metrics.endpoint_name(url))
+        return body
+
+    @staticmethod
+    def _next_page(page, endpoint, params):
+        pagination = page.get("meta", {}).get("pagination")
+        if pagination:
+            current_page = pagination.get("current_page", 1)
+            if current_page >= pagination.get("total_pages", 1):
+                return None, None
+        next_link = (page.get("links") or {}).get("next")
+        if next_link:
+            return next_link, None
+        if pagination:
+            return endpoint, dict(params or {}, page=current_page + 1)
+        return None, None
+
+    def _iter(self, endpoint, params=None, model=None):
+        """
+        Yield the items of every page of a listing. The next page is requested in the
+        background while the current one is consumed, or right away if the prefetch
+        hasn't started by then. Nothing further is fetched once the caller stops iterating.
+        """
+        page = self._get_page(endpoint, params=params)
+        while True:
+            next_endpoint, next_params = self._next_page(page, endpoint, params)
+            upcoming = None
+            if next_endpoint:
+                upcoming = _prefetch_pool.submit(self._get_page, next_endpoint, next_params)
+            try:
+                for item in page.get("data", []):
+                    yield model.from_json(item) if model else item
+            except GeneratorExit:
+                if upcoming is not None:
+                    upcoming.cancel()
+                raise
+            if upcoming is None:
+                return
+            # a prefetch still queued behind other listings, eg of a slow host, is not waited for
+            if upcoming.cancel():
+                page = self._get_page(next_endpoint, next_params)
+            else:
+                page = upcoming.result()
+
+    def _stream(self, endpoint, params=None, model=None):
+        """
+        Yield the items of every page of a listing while the response is read, holding
+        only one item in memory at a time. Pages are requested one after the other.
+        """
+        params = dict(params or {}, limit=STREAM_PAGE_SIZE)
+        while endpoint:
+            response = self._request("GET", endpoint, params=params, stream=True)
+            with closing(response):
+                response.raise_for_status()
+                items = iter_members(response.iter_content(STREAM_CHUNK_SIZE))
+                while True:
+                    try:
+                        item = next(items)
+                    except StopIteration as end:
+                        rest = end.value
+                        break
+                    yield model.from_json(item) if model else item
+            endpoint, params = self._next_page(rest, endpoint, params)
+
+    def _cached_list(self, resource, loader, *args):
+        if self.cache is None:
+            return list(loader(*args))
+        return self.cache.get_or_load((self.cache_key, resource) + args, lambda: list(loader(*args)),
+                                     self.min_ttl)
+
+    def _cached_index(self, resource, loader, *args):
+        """Items of a listing by lower case name. Kept apart from the listing, a write doesn't change names"""
+        if self.cache is None:
+            return name_index(loader(*args))
+        return self.cache.get_or_load((self.cache_key, resource) + args, lambda: name_index(loader(*args)),
+                                     self.min_ttl)
+
+    def _invalidate(self, resources=TX_DEPENDENT_RESOURCES):
+        if self.cache is not None:
+            self.cache.invalidate(lambda key: key[0] == self.cache_key and key[1] in resources)
+
+    def _record(self, response, deleted_id=None):
+        """Apply a successful write to the local transaction mirror"""
+        if self.mirror is None:
+            return
+        if deleted_id is not None:
+            if response.status_code == 204:
+                self.mirror.delete(self.cache_key, deleted_id)
+        elif response.status_code == 200:
+            self.mirror.upsert(self.cache_key, [Transaction.from_json(response.json().get("data"))])
 
     def get_transactions(self, tx_type="all"):
         return self._get("transactions", params={"type": tx_type})
 
+    def iter_transactions(self, tx_type="all", start=None, end=None):
+        """`start` and `end` are inclusive dates in the form YYYY-MM-DD"""
+        return self._iter("transactions", params=date_range({"type": tx_type}, start, end), model=Transaction)
+
+    def stream_transactions(self, tx_type="all", start=None, end=None):
+        """Like `iter_transactions` with constant memory, for going through the whole ledger"""
+        return self._stream("transactions", params=date_range({"type": tx_type}, start, end), model=Transaction)
+
     def get_transaction(self, tx_id):
         return self._get(f"transactions/{tx_id}")
 
+    def load_transaction(self, tx_id):
+        data = self.get_transaction(tx_id).get("data")
+        return Transaction.from_json(data) if data else None
+
     def delete_transaction(self, tx_id):
-        return self._delete(f"transactions/{tx_id}")
+        response = self._delete(f"transactions/{tx_id}")
+        self._invalidate()
+        self._record(response, deleted_id=tx_id)
+        return response
 
     def get_budgets(self):
         return self._get("budgets")
 
+    def iter_budgets(self):
+        return self._iter("budgets", model=Budget)
+
+    def list_budgets(self):
+        return self._cached_list("budgets", self.iter_budgets)
+
+    def budget_names(self):
+        return self._cached_index("budget_names", self.iter_budgets)
+
+    def get_categories(self):
+        return self._get("categories")
+
+    def iter_categories(self):
+        return self._iter("categories", model=Category)
+
+    def list_categories(self):
+        return self._cached_list("categories", self.iter_categories)
+
+    def category_names(self):
+        return self._cached_index("category_names", self.iter_categories)
+
     def get_accounts(self, account_type="asset"):
         return self._get("accounts", params={"type": account_type})
 
+    def iter_accounts(self, account_type="asset"):
+        return self._iter("accounts", params={"type": account_type}, model=Account)
+
+    def list_accounts(self, account_type="asset"):
+        return self._cached_list("accounts", self.iter_accounts, account_type)
+
+    def account_names(self, account_type="asset"):
+        return self._cached_index("account_names", self.iter_accounts, account_type)
+
+    def stream_accounts(self, account_type="asset"):
+        return self._stream("accounts", params={"type": account_type}, model=Account)
+
     def get_rules(self):
         return self._get("rules")
 
+    def iter_rules(self):
+        return self._iter("rules", model=Rule)
+
+    def list_rules(self):
+        return self._cached_list("rules", self.iter_rules)
+
     def get_account(self, account_id):
         return self._get(f"accounts/{account_id}")
 
+    def load_account(self, account_id):
+        data = self.get_account(account_id).get("data")
+        return Account.from_json(data) if data else None
+
     def get_bills(self):
         return self._get("bills")
 
+    def iter_bills(self):
+        return self._iter("bills")
+
+    def list_bills(self):
+        return self._cached_list("bills", self.iter_bills)
+
     def get_about_user(self):
         return self._get("about/user")
 
     def update_transaction(self, transaction_id, **kwargs):
-        payload = {
-            "transactions": [{}]
-        }
-        for key, value in kwargs.items():
-            if key not in tx_attrs:
-                raise ValueError(f"Cannot set key {key} on a transaction")
-            payload["transactions"][0][key] = value
-        return self._put(endpoint=f"transactions/{transaction_id}", payload=payload)
+        payload = update_payload(**kwargs)
+        response = self._put(endpoint=f"transactions/{transaction_id}", payload=payload)
+        self._invalidate()
+        self._record(response)
+        return response
 
     def create_transaction(self, **kwargs):
-        if "type" not in kwargs.keys():
-            raise ValueError(f"Must specify transaction type")
-        now = datetime.datetime.now()
-        payload = {
-            "transactions": [{}]
-        }
-        for key, value in kwargs.items():
-            if key not in tx_attrs:
-                raise ValueError(f"Cannot set key {key} on a transaction")
-            payload["transactions"][0][key] = value
-        if not payload["transactions"][0]["date"]:
-            payload["transactions"][0]["date"] = now.strftime("%Y-%m-%d")
-        return self._post(endpoint="transactions", payload=payload)
+        payload = transaction_payload(**kwargs)
+        response = self._post(endpoint="transactions", payload=payload)
+        self._invalidate()
+        self._record(response)
+        return response
+
+    def create_transaction_group(self, payload):
+        response = self._post(endpoint="transactions", payload=payload)
+        self._invalidate()
+        self._record(response)
+        return response
 
     def create_withdrawal(self, amount, description, source_account, destination_account=None, category=None, budget=None):
-        now = datetime.datetime.now()
-        payload = {
-            "transactions": [{
-                "type": "withdrawal",
-                "description": description,
-                "date": now.strftime("%Y-%m-%d"),
-                "amount": amount,
-                "budget_name": budget,
-                "category_name": category,
-            }]
-        }
-        if source_account.isnumeric():
-            payload["transactions"][0]["source_id"] = source_account
-        else:
-            payload["transactions"][0]["source_name"] = source_account
+        payload = withdrawal_payload(amount, description, source_account, destination_account, category, budget)
+        response = self._post(endpoint="transactions", payload=payload)
+        self._invalidate()
+        self._record(response)
+        return response
 
-        if destination_account:
-            if destination_account.isnumeric():
-                payload["transactions"][0]["destination_id"] = destination_account
-            else:
-                payload["transactions"][0]["destination_name"] = destination_account
-        else:
-            payload["transactions"][0]["destination_name"] = description
+    def create_transactions(self, payloads, concurrency=BULK_CONCURRENCY):
+        """
+        Submit many transaction groups (see `group_payload`) with at most `concurrency`
+        requests in flight. Returns one `BulkResult` per payload, in order.
+        """
+        def submit(item):
+            index, payload = item
+            try:
+                response = self._post(endpoint="transactions", payload=payload)
+            except requests.RequestException as e:
+                return BulkResult(index, None, None, str(e))
+            self._record(response)
+            return bulk_result(index, response)
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results = list(executor.map(submit, enumerate(payloads)))
+        self._invalidate()
+        return results
 
-        return self._post(endpoint="transactions", payload=payload)
+
+BulkResult = namedtuple("BulkResult", ["index", "status_code", "tx_id", "error"])
+
+
+def bulk_result(index, response):
+    try:
+        body = response.json()
+    except ValueError:
+        body = {}
+    if response.status_code == 200:
+        return BulkResult(index, response.status_code, body.get("data", {}).get("id"), None)
+    return BulkResult(index, response.status_code, None, body.get("message") or f"HTTP {response.status_code}")
+
+
+def name_index(items):
+    return {item.name.lower(): item for item in items}
+
+
+def date_range(params, start=None, end=None):
+    params = dict(params)
+    if start:
+        params["start"] = start
+    if end:
+        params["end"] = end
+    return params
+
+
+def update_payload(**kwargs):
+    unknown = kwargs.keys() - TX_ATTRS
+    if unknown:
+        raise ValueError(f"Cannot set key {unknown.pop()} on a transaction")
+    split = {key: str(value) if isinstance(value, Decimal) else value for key, value in kwargs.items()}
+    return {"transactions": [split]}
+
+
+def transaction_payload(**kwargs):
+    if "type" not in kwargs.keys():
+        raise ValueError(f"Must specify transaction type")
+    now = datetime.datetime.now()
+    payload = update_payload(**kwargs)
+    if not payload["transactions"][0].get("date"):
+        payload["transactions"][0]["date"] = now.strftime("%Y-%m-%d")
+    return payload
+
+
+def group_payload(splits, group_title=None):
+    """Build one transaction group out of several splits, each a dict of `tx_attrs` keys"""
+    if not splits:
+        raise ValueError("A transaction needs at least one split")
+    payload = {"transactions": [transaction_payload(**split)["transactions"][0] for split in splits]}
+    if len(splits) > 1:
+        payload["group_title"] = group_title or splits[0].get("description")
+    elif group_title:
+        payload["group_title"] = group_title
+    return payload
+
+
+def withdrawal_payload(amount, description, source_account, destination_account=None, category=None, budget=None):
+    now = datetime.datetime.now()
+    payload = {
+        "transactions": [{
+            "type": "withdrawal",
+            "description": description,
+            "date": now.strftime("%Y-%m-%d"),
+            "amount": amount,
+            "budget_name": budget,
+            "category_name": category,
+        }]
+    }
+    if source_account.isnumeric():
+        payload["transactions"][0]["source_id"] = source_account
+    else:
+        payload["transactions"][0]["source_name"] = source_account
+
+    if destination_account:
+        if destination_account.isnumeric():
+            payload["transactions"][0]["destination_id"] = destination_account
+        else:
+            payload["transactions"][0]["destination_name"] = destination_account
+    else:
+        payload["transactions"][0]["destination_name"] = description
+    return payload
@@ -0,0 +1,132 @@
+"""
+Turns CSV bank statements into Firefly transaction groups.
+
+The first row names the columns, matched case-insensitively: `date`, `amount` and
+`description` are required, `category`, `budget`, `source`, `destination`, `notes`
+and `group` are optional. Negative amounts are withdrawals from the default account,
+positive ones deposits into it. Consecutive rows sharing a `group` value become the
+splits of a single transaction.
+"""
+import csv
+import datetime
+import io
+from decimal import Decimal, InvalidOperation
+
+from firefly import group_payload
+
+DATE_FORMATS = ("%Y-%m-%d", "%d.%m.%Y", "%d/%m/%Y", "%m/%d/%Y")
+REQUIRED_COLUMNS = ("date", "amount", "description")
+
+
+class StatementError(ValueError):
+    pass
+
+
+def parse_date(value):
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(value.strip(), date_format).strftime("%Y-%m-%d")
+        except ValueError:
+            pass
+    raise StatementError(f"Unknown date format '{value}'")
+
+
+def parse_amount(value):
+    value = value.strip().replace(" ", "").replace("'", "")
+    if "," in value and "." in value:
+        # with both separators present, the last one is the decimal mark
+        if value.rindex(",") > value.rindex("."):
+            value = value.replace(".", "").replace(",", ".")
+        else:
+            value = value.replace(",", "")
+    else:
+        value = value.replace(",", ".")
+    try:
+        amount = Decimal(value)
+    except InvalidOperation:
+        raise StatementError(f"Invalid amount '{value}'")
+    if not amount.is_finite():
+        raise StatementError(f"Invalid amount '{value}'")
+    return amount
+
+
+def account_fields(prefix, account):
+    if account.isnumeric():
+        return {f"{prefix}_id": account}
+    return {f"{prefix}_name": account}
+
+
+def row_split(row, default_account):
+    amount = parse_amount(row["amount"])
+    if not amount:
+        raise StatementError("Amount is zero")
+    description = row["description"].strip()
+    if not description:
+        raise StatementError("Description is empty")
+    split = {
+        "type": "withdrawal" if amount < 0 else "deposit",
+        "date": parse_date(row["date"]),
+        "amount": str(abs(amount)),
+        "description": description,
+    }
+    if amount < 0:
+        split.update(account_fields("source", row.get("source") or default_account))
+        split.update(account_fields("destination", row.get("destination") or description))
+    else:
+        split.update(account_fields("source", row.get("source") or description))
+        split.update(account_fields("destination", row.get("destination") or default_account))
+    for column, key in (("category", "category_name"), ("budget", "budget_name"), ("notes", "notes")):
+        if row.get(column):
+            split[key] = row[column]
+    return split
+
+
+def decode_statement(data):
+    """
+    Text of an uploaded statement. It is decoded and parsed as a whole up front, so a
+    broken file fails before any of its transactions is imported.
+    """
+    try:
+        text = data.decode("utf-8-sig")
+    except UnicodeDecodeError as e:
+        raise StatementError(f"The file is not UTF-8 text: {e}")
+    reader = csv.reader(io.StringIO(text, newline=""))
+    try:
+        for _ in reader:
+            pass
+    except csv.Error as e:
+        raise StatementError(f"line {reader.line_num}: {e}")
+    return text
+
+
+def read_statement(lines, default_account):
+    """
+    Yield `(line_number, payload, error)` for every transaction of a CSV statement,
+    reading it row by row. Exactly one of payload and error is set.
+    """
+    reader = csv.DictReader(lines)
+    if reader.fieldnames is None:
+        return
+    reader.fieldnames = [name.strip().lower() for name in reader.fieldnames]
+    missing = [column for column in REQUIRED_COLUMNS if column not in reader.fieldnames]
+    if missing:
+        raise StatementError(f"Missing columns: {', '.join(missing)}")
+
+    group, group_line, splits = None, None, []
+    for row in reader:
+        row = {key: (value or "").strip() for key, value in row.items() if key}
+        try:
+            split = row_split(row, default_account)
+        except StatementError as e:
+            yield reader.line_num, None, str(e)
+            continue
+        row_group = row.get("group")
+        if splits and (not row_group or row_group != group):
+            yield group_line, group_payload(splits, group), None
+            splits = []
+        if not splits:
+            group_line = reader.line_num
+        group = row_group
+        splits.append(split)
+    if splits:
+        yield group_line, group_payload(splits, group), None
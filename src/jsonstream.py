@@ -0,0 +1,97 @@
+"""
+Incremental decoding of JSON:API documents.
+
+`iter_members` walks the top level object of a document as it arrives and yields
+the elements of one array member, `data` by default, one at a time. Only the element
+being decoded and the undecoded rest of the current chunk are held in memory, so a
+listing of any size is consumed with constant memory. The other top level members,
+eg `meta` and `links`, are decoded whole and returned when the generator finishes.
+"""
+import codecs
+import json
+
+_decoder = json.JSONDecoder()
+WHITESPACE = " \t\n\r"
+
+
+class _Reader(object):
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.utf8 = codecs.getincrementaldecoder("utf-8")()
+        self.buffer = ""
+        self.pos = 0
+        self.exhausted = False
+
+    def more(self):
+        if self.exhausted:
+            return False
+        # drop what has been consumed, the buffer never holds more than a chunk and one value
+        self.buffer = self.buffer[self.pos:]
+        self.pos = 0
+        for chunk in self.chunks:
+            if chunk:
+                self.buffer += self.utf8.decode(chunk)
+                return True
+        self.buffer += self.utf8.decode(b"", final=True)
+        self.exhausted = True
+        return True
+
+    def peek(self):
+        """Next character that isn't whitespace, without consuming it"""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.more():
+                raise json.JSONDecodeError("Unexpected end of document", self.buffer, self.pos)
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise json.JSONDecodeError(f"Expected '{char}'", self.buffer, self.pos)
+        self.pos += 1
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buffer, self.pos)
+                # a number at the end of the buffer may continue in the next chunk
+                if end < len(self.buffer) or self.exhausted:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.exhausted:
+                    raise
+            self.more()
+
+
+def iter_members(chunks, key="data"):
+    """
+    Yield the elements of the array `key` of the JSON object read from `chunks`, an
+    iterable of bytes. Returns the other members as a dict, use `yield from` to get it.
+    """
+    reader = _Reader(chunks)
+    rest = {}
+    reader.expect("{")
+    if reader.peek() == "}":
+        return rest
+    while True:
+        name = reader.value()
+        reader.expect(":")
+        if name == key and reader.peek() == "[":
+            reader.pos += 1
+            if reader.peek() == "]":
+                reader.pos += 1
+            else:
+                while True:
+                    yield reader.value()
+                    if reader.peek() == "]":
+                        reader.pos += 1
+                        break
+                    reader.expect(",")
+        else:
+            rest[name] = reader.value()
+        if reader.peek() == "}":
+            return rest
+        reader.expect(",")
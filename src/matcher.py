@@ -0,0 +1,83 @@
+from collections import deque
+
+from cache import TTLCache
+
+REQUIRED_ACTIONS = frozenset(["set_source_account", "set_destination_account"])
+
+
+class RuleMatcher(object):
+    """
+    Aho-Corasick automaton over the `description_contains` triggers of the rules that
+    set both source and destination account. Matching a description walks it once, so
+    the cost depends on the length of the text and not on the number of rules.
+    """
+
+    def __init__(self, rules):
+        self.rules = rules
+        self.fingerprint = rules_fingerprint(rules)
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [()]
+        for index, rule in enumerate(rules):
+            if not REQUIRED_ACTIONS <= rule.action_types:
+                continue
+            for trigger_type, value in rule.triggers:
+                if trigger_type == "description_contains" and value:
+                    self._add(value.lower(), index)
+        self._build()
+
+    def _add(self, pattern, rule_index):
+        state = 0
+        for char in pattern:
+            next_state = self._goto[state].get(char)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][char] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append(())
+            state = next_state
+        self._out[state] += (rule_index,)
+
+    def _build(self):
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fallback = self._fail[state]
+                while fallback and char not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                self._fail[next_state] = self._goto[fallback].get(char, 0)
+                self._out[next_state] += self._out[self._fail[next_state]]
+
+    def match(self, text):
+        """Return the matching rules, each once and in their original order"""
+        goto, fail, out = self._goto, self._fail, self._out
+        matched = set()
+        state = 0
+        for char in text.lower():
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if out[state]:
+                matched.update(out[state])
+        return [self.rules[index] for index in sorted(matched)]
+
+
+def rules_fingerprint(rules):
+    return tuple((rule.id, rule.updated_at) for rule in rules)
+
+
+# compiled matchers per user, rebuilt only when the rules behind them change
+_matchers = TTLCache(maxsize=256, ttl=24 * 3600)
+
+
+def get_rule_matcher(user_key, rules):
+    matcher = _matchers.get(user_key)
+    if matcher is not None and (matcher.rules is rules or matcher.fingerprint == rules_fingerprint(rules)):
+        matcher.rules = rules
+        return matcher
+    matcher = RuleMatcher(rules)
+    _matchers.set(user_key, matcher)
+    return matcher
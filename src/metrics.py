@@ -0,0 +1,170 @@
+"""
+Lightweight in-process metrics in the Prometheus text format.
+
+Recording a value takes a lock and a bisect, so it is cheap enough to stay on in
+production. The values can be scraped from `start_http_server` or logged through
+`summary`.
+"""
+import logging
+import re
+import threading
+import time
+from bisect import bisect_left
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+ID_SEGMENT = re.compile(r"/\d+(?=/|$)")
+
+_metrics = []
+_gauges = []
+
+
+def _labels(names, values, extra=""):
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter(object):
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def inc(self, amount=1, *label_values):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for label_values, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_labels(self.labels, label_values)} {value}")
+        return lines
+
+
+class Histogram(object):
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def observe(self, value, *label_values):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for label_values, (counts, total) in sorted(self._series.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += bucket_count
+                    le = 'le="{}"'.format("+Inf" if bound == float("inf") else bound)
+                    lines.append(f"{self.name}_bucket{_labels(self.labels, label_values, le)} {cumulative}")
+                lines.append(f"{self.name}_sum{_labels(self.labels, label_values)} {total}")
+                lines.append(f"{self.name}_count{_labels(self.labels, label_values)} {cumulative}")
+        return lines
+
+    def summary(self):
+        with self._lock:
+            return {"/".join(map(str, label_values)): dict(count=sum(counts), mean_ms=total / sum(counts) * 1000)
+                    for label_values, (counts, total) in self._series.items() if sum(counts)}
+
+
+firefly_request_seconds = Histogram("firefly_request_duration_seconds", "Latency of Firefly API calls",
+                                    labels=("method", "endpoint", "status"))
+firefly_response_bytes = Counter("firefly_response_bytes_total", "Size of Firefly API responses",
+                                 labels=("method", "endpoint"))
+firefly_coalesced_requests = Counter("firefly_coalesced_requests_total",
+                                     "GET requests answered by an identical request in flight", labels=("endpoint",))
+firefly_throttle_seconds = Counter("firefly_throttle_seconds_total", "Time requests waited for the per host rate limit")
+handler_seconds = Histogram("bot_handler_duration_seconds", "Wall time of bot callbacks", labels=("handler",))
+
+
+def register_gauges(name, collect):
+    """`collect()` returns a dict of numbers, exported as `<name>_<key>` gauges"""
+    _gauges.append((name, collect))
+
+
+def endpoint_name(url):
+    """Turn a Firefly URL into a label without host, query and ids, eg `transactions/{id}`"""
+    path = urlparse(url).path
+    path = path.split("/api/v1/", 1)[-1]
+    return ID_SEGMENT.sub("/{id}", "/" + path.strip("/"))[1:]
+
+
+def record_request(method, url, status, seconds, size):
+    endpoint = endpoint_name(url)
+    firefly_request_seconds.observe(seconds, method, endpoint, str(status))
+    firefly_response_bytes.inc(size, method, endpoint)
+
+
+def render():
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    for name, collect in _gauges:
+        for key, value in collect().items():
+            lines.append(f"# TYPE {name}_{key} gauge")
+            lines.append(f"{name}_{key} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def summary():
+    return {
+        "firefly": firefly_request_seconds.summary(),
+        "handlers": handler_seconds.summary(),
+    }
+
+
+def timed(name, callback):
+    @wraps(callback)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return callback(*args, **kwargs)
+        finally:
+            handler_seconds.observe(time.perf_counter() - start, name)
+    return wrapper
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_http_server(port, addr="0.0.0.0"):
+    httpd = ThreadingHTTPServer((addr, port), MetricsHandler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, name="metrics", daemon=True).start()
+    logger.info("Serving metrics on %s:%s/metrics", addr, port)
+    return httpd
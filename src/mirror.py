@@ -0,0 +1,244 @@
+"""
+Local copy of every user's transactions in SQLite.
+
+Listing, showing and picking transactions is answered from here. The mirror is kept
+current by the bot's own writes, by an incremental sync of the most recent days
+through Firefly's date filter, and by a periodic full reconciliation that also
+catches edits and deletions made outside the bot.
+
+The mirror also keeps the report totals of closed months. Whatever changes the
+transactions of a month drops its totals, so they are computed again when asked for.
+"""
+import datetime
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+import requests
+
+from models import Transaction
+
+logger = logging.getLogger(__name__)
+
+SYNC_INTERVAL = 60
+RECONCILE_INTERVAL = 24 * 3600
+# days before the newest known transaction that every incremental sync fetches again
+SYNC_OVERLAP_DAYS = 7
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS transactions (
+    owner TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    type TEXT,
+    date TEXT,
+    description TEXT,
+    data TEXT NOT NULL,
+    PRIMARY KEY (owner, id)
+);
+CREATE INDEX IF NOT EXISTS transactions_recent ON transactions (owner, type, date DESC, id DESC);
+CREATE TABLE IF NOT EXISTS month_totals (
+    owner TEXT NOT NULL,
+    month TEXT NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (owner, month)
+);
+CREATE TABLE IF NOT EXISTS sync_state (
+    owner TEXT PRIMARY KEY,
+    synced_at REAL NOT NULL,
+    reconciled_at REAL NOT NULL
+);
+"""
+
+
+def owner_key(cache_key):
+    """Rows are stored per Firefly login, without keeping its token in the file"""
+    hostname, auth_token = cache_key
+    return hashlib.blake2b(f"{hostname}\0{auth_token}".encode(), digest_size=16).hexdigest()
+
+
+def _month(date):
+    return date[:7] if date else None
+
+
+def month_bounds(month):
+    """First day of `month`, YYYY-MM, and of the month after it"""
+    year, number = int(month[:4]), int(month[5:7])
+    following = f"{year + 1}-01" if number == 12 else f"{year}-{number + 1:02}"
+    return f"{month}-01", f"{following}-01"
+
+
+def _row(owner, tx):
+    split = tx.split
+    return owner, int(tx.id), split.type, split.date, split.description, json.dumps(tx.to_json())
+
+
+class TransactionMirror(object):
+    def __init__(self, path, sync_interval=SYNC_INTERVAL, reconcile_interval=RECONCILE_INTERVAL):
+        self.path = str(path)
+        self.sync_interval = sync_interval
+        self.reconcile_interval = reconcile_interval
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(SCHEMA)
+
+    def _transactions(self, sql, args=()):
+        with self._lock:
+            rows = self._db.execute(sql, args).fetchall()
+        return [Transaction.from_json(json.loads(data)) for data, in rows]
+
+    def _forget_months(self, owner, ids, months=()):
+        """Drop the totals of `months` and of the months the transactions `ids` are stored in"""
+        months = set(months)
+        for tx_id in ids:
+            row = self._db.execute("SELECT date FROM transactions WHERE owner = ? AND id = ?",
+                                   (owner, tx_id)).fetchone()
+            if row:
+                months.add(_month(row[0]))
+        self._db.executemany("DELETE FROM month_totals WHERE owner = ? AND month = ?",
+                             [(owner, month) for month in months if month])
+
+    def upsert(self, key, transactions):
+        owner = owner_key(key)
+        rows = [_row(owner, tx) for tx in transactions]
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                self._forget_months(owner, [row[1] for row in rows], [_month(row[3]) for row in rows])
+                self._db.executemany("INSERT OR REPLACE INTO transactions VALUES (?, ?, ?, ?, ?, ?)", rows)
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def delete(self, key, tx_id):
+        owner = owner_key(key)
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                self._forget_months(owner, [int(tx_id)])
+                self._db.execute("DELETE FROM transactions WHERE owner = ? AND id = ?", (owner, int(tx_id)))
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def get(self, key, tx_id):
+        transactions = self._transactions("SELECT data FROM transactions WHERE owner = ? AND id = ?",
+                                          (owner_key(key), int(tx_id)))
+        return transactions[0] if transactions else None
+
+    def recent(self, key, tx_type="withdrawal", limit=50, offset=0):
+        """The newest transactions of a type, newest first"""
+        return self._transactions(
+            "SELECT data FROM transactions WHERE owner = ? AND type = ? ORDER BY date DESC, id DESC LIMIT ? OFFSET ?",
+            (owner_key(key), tx_type, limit, offset))
+
+    def search(self, key, text, limit=50, offset=0):
+        """Transactions whose description contains `text`, ignoring case, newest first"""
+        pattern = "%" + text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+        return self._transactions(
+            "SELECT data FROM transactions WHERE owner = ? AND description LIKE ? ESCAPE '\\' "
+            "ORDER BY date DESC, id DESC LIMIT ? OFFSET ?", (owner_key(key), pattern, limit, offset))
+
+    def between(self, key, start, end, tx_type="withdrawal"):
+        """Transactions of a type dated from `start` up to, not including, `end`"""
+        return self._transactions(
+            "SELECT data FROM transactions WHERE owner = ? AND type = ? AND date >= ? AND date < ?",
+            (owner_key(key), tx_type, start, end))
+
+    def month_totals(self, key, month, aggregate, tx_type="withdrawal"):
+        """
+        Stored totals of a closed month, YYYY-MM. When there are none `aggregate` computes
+        them from the month's transactions, it has to return something JSON serializable.
+        The transactions are read and the totals stored in one write transaction, so a
+        concurrent sync can't leave totals behind that no longer match.
+        """
+        owner = owner_key(key)
+        start, end = month_bounds(month)
+        with self._lock:
+            row = self._db.execute("SELECT data FROM month_totals WHERE owner = ? AND month = ?",
+                                   (owner, month)).fetchone()
+            if row:
+                return json.loads(row[0])
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self._db.execute(
+                    "SELECT data FROM transactions WHERE owner = ? AND type = ? AND date >= ? AND date < ?",
+                    (owner, tx_type, start, end))
+                totals = aggregate(Transaction.from_json(json.loads(data)) for data, in rows)
+                self._db.execute("INSERT OR REPLACE INTO month_totals VALUES (?, ?, ?)",
+                                 (owner, month, json.dumps(totals)))
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+        return totals
+
+    def _replace(self, owner, transactions, since=None):
+        """
+        Swap the rows of an owner, or only those dated `since` or later, in one transaction.
+        `transactions` may be a stream, it is written to a temporary table of its own
+        connection while it downloads. Neither memory nor the lock of the mirror file
+        are held for longer than the final swap.
+        """
+        db = sqlite3.connect(self.path, isolation_level=None, timeout=30)
+        try:
+            db.execute("CREATE TEMP TABLE staging (owner TEXT, id INTEGER PRIMARY KEY, type TEXT, date TEXT, "
+                       "description TEXT, data TEXT)")
+            db.executemany("INSERT OR REPLACE INTO staging VALUES (?, ?, ?, ?, ?, ?)",
+                           (_row(owner, tx) for tx in transactions))
+            now = time.time()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                if since is None:
+                    db.execute("DELETE FROM transactions WHERE owner = ?", (owner,))
+                    db.execute("DELETE FROM month_totals WHERE owner = ?", (owner,))
+                else:
+                    db.execute("DELETE FROM transactions WHERE owner = ? AND date >= ?", (owner, since))
+                    db.execute("DELETE FROM month_totals WHERE owner = ? AND month >= ?", (owner, _month(since)))
+                db.execute("INSERT OR REPLACE INTO transactions SELECT * FROM staging")
+                if since is None:
+                    db.execute("INSERT OR REPLACE INTO sync_state VALUES (?, ?, ?)", (owner, now, now))
+                else:
+                    db.execute("UPDATE sync_state SET synced_at = ? WHERE owner = ?", (now, owner))
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+        finally:
+            db.close()
+
+    def refresh(self, firefly, force=False):
+        """
+        Bring the transactions of a Firefly login up to date, with a full download when
+        the last one is older than `reconcile_interval` and otherwise with the recent
+        days only. Without `force` nothing is fetched within `sync_interval` of the last
+        sync. Returns False if Firefly could not be reached, the mirror then stays as it was.
+        """
+        owner = owner_key(firefly.cache_key)
+        with self._lock:
+            state = self._db.execute("SELECT synced_at, reconciled_at FROM sync_state WHERE owner = ?",
+                                     (owner,)).fetchone()
+            newest = self._db.execute("SELECT MAX(date) FROM transactions WHERE owner = ?", (owner,)).fetchone()[0]
+        now = time.time()
+        try:
+            if state is None or now - state[1] >= self.reconcile_interval:
+                self._replace(owner, firefly.stream_transactions())
+            elif force or now - state[0] >= self.sync_interval:
+                since = None
+                if newest:
+                    since = (datetime.date.fromisoformat(newest[:10]) -
+                             datetime.timedelta(days=SYNC_OVERLAP_DAYS)).isoformat()
+                self._replace(owner, firefly.stream_transactions(start=since), since=since)
+        except requests.RequestException as e:
+            logger.warning("Syncing transactions from %s failed: %s", firefly.cache_key[0], e)
+            return False
+        return True
+
+    def close(self):
+        with self._lock:
+            self._db.close()
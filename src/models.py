@@ -0,0 +1,119 @@
+"""
+Compact models for Firefly API objects, decoded once from the JSON:API documents.
+Amounts are kept as exact Decimals.
+"""
+from decimal import Decimal
+
+
+def _decimal(value):
+    return Decimal(value) if value not in (None, "") else None
+
+
+class Split(object):
+    __slots__ = ("type", "date", "amount", "description", "currency_code", "currency_symbol",
+                 "currency_decimal_places", "source_id", "source_name", "destination_id", "destination_name",
+                 "category_id", "category_name", "budget_id", "budget_name")
+
+    def __init__(self, **kwargs):
+        for name in self.__slots__:
+            setattr(self, name, kwargs.get(name))
+
+    @classmethod
+    def from_json(cls, data):
+        split = cls(**data)
+        split.amount = _decimal(data.get("amount"))
+        if split.currency_decimal_places is None:
+            split.currency_decimal_places = 2
+        return split
+
+    def to_json(self):
+        data = {name: getattr(self, name) for name in self.__slots__}
+        data["amount"] = str(self.amount) if self.amount is not None else None
+        return data
+
+    @property
+    def quantum(self):
+        """Smallest amount of the split's currency, eg Decimal("0.01")"""
+        return Decimal(1).scaleb(-self.currency_decimal_places)
+
+
+class Transaction(object):
+    __slots__ = ("id", "group_title", "splits")
+
+    def __init__(self, id, group_title, splits):
+        self.id = id
+        self.group_title = group_title
+        self.splits = splits
+
+    @classmethod
+    def from_json(cls, data):
+        attributes = data.get("attributes")
+        return cls(data.get("id"), attributes.get("group_title"),
+                   tuple(Split.from_json(split) for split in attributes.get("transactions")))
+
+    def to_json(self):
+        return {"type": "transactions", "id": self.id, "attributes": {
+            "group_title": self.group_title, "transactions": [split.to_json() for split in self.splits]}}
+
+    @property
+    def split(self):
+        return self.splits[0]
+
+
+class Account(object):
+    __slots__ = ("id", "name", "type", "role", "active", "current_balance", "currency_code", "currency_symbol")
+
+    def __init__(self, id, name, type, role, active, current_balance, currency_code, currency_symbol):
+        self.id = id
+        self.name = name
+        self.type = type
+        self.role = role
+        self.active = active
+        self.current_balance = current_balance
+        self.currency_code = currency_code
+        self.currency_symbol = currency_symbol
+
+    @classmethod
+    def from_json(cls, data):
+        attributes = data.get("attributes")
+        return cls(data.get("id"), attributes.get("name"), attributes.get("type"), attributes.get("account_role"),
+                   attributes.get("active"), _decimal(attributes.get("current_balance")),
+                   attributes.get("currency_code"), attributes.get("currency_symbol"))
+
+
+class Rule(object):
+    __slots__ = ("id", "title", "updated_at", "triggers", "actions")
+
+    def __init__(self, id, title, updated_at, triggers, actions):
+        self.id = id
+        self.title = title
+        self.updated_at = updated_at
+        self.triggers = triggers
+        self.actions = actions
+
+    @classmethod
+    def from_json(cls, data):
+        attributes = data.get("attributes")
+        return cls(data.get("id"), attributes.get("title"), attributes.get("updated_at"),
+                   tuple((t.get("type"), t.get("value")) for t in attributes.get("triggers")),
+                   tuple((a.get("type"), a.get("value")) for a in attributes.get("actions")))
+
+    @property
+    def action_types(self):
+        return {action_type for action_type, value in self.actions}
+
+
+class Budget(object):
+    __slots__ = ("id", "name")
+
+    def __init__(self, id, name):
+        self.id = id
+        self.name = name
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(data.get("id"), data.get("attributes").get("name"))
+
+
+class Category(Budget):
+    __slots__ = ()
@@ -0,0 +1,202 @@
+"""
+Durable queue for transactions that still have to reach Firefly.
+
+Entries are written to SQLite before the user gets an answer, and a background
+worker delivers them with exponential backoff. Each entry carries an idempotency
+key in `internal_reference`, and Firefly is asked to reject duplicates. A retry
+after a lost response is then reported as a duplicate and not booked twice.
+"""
+import json
+import logging
+import random
+import re
+import sqlite3
+import threading
+import time
+import uuid
+from collections import namedtuple
+
+import requests
+
+from firefly import Firefly
+
+logger = logging.getLogger(__name__)
+
+PENDING, DELIVERED, FAILED = "pending", "delivered", "failed"
+BACKOFF_BASE = 5
+BACKOFF_MAX = 3600
+MAX_ATTEMPTS = 20
+DUPLICATE = re.compile(r"Duplicate of transaction #(\d+)")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    idempotency_key TEXT NOT NULL UNIQUE,
+    chat_id INTEGER NOT NULL,
+    hostname TEXT NOT NULL,
+    auth_token TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt REAL NOT NULL,
+    created REAL NOT NULL,
+    tx_id TEXT,
+    last_error TEXT
+);
+CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, next_attempt);
+"""
+
+Entry = namedtuple("Entry", ["id", "idempotency_key", "chat_id", "hostname", "auth_token", "payload",
+                             "status", "attempts", "next_attempt", "created", "tx_id", "last_error"])
+
+
+class Outbox(object):
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(SCHEMA)
+
+    def _entries(self, sql, args=()):
+        with self._lock:
+            rows = self._db.execute(sql, args).fetchall()
+        return [Entry(*row[:5], json.loads(row[5]), *row[6:]) for row in rows]
+
+    def _update(self, sql, args):
+        with self._lock:
+            self._db.execute(sql, args)
+
+    def enqueue(self, chat_id, hostname, auth_token, payload):
+        key = uuid.uuid4().hex
+        payload = dict(payload, error_if_duplicate_hash=True)
+        payload["transactions"] = [dict(split, internal_reference=f"firefly-bot:{key}")
+                                   for split in payload["transactions"]]
+        now = time.time()
+        with self._lock:
+            cursor = self._db.execute(
+                "INSERT INTO outbox (idempotency_key, chat_id, hostname, auth_token, payload, next_attempt, created) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)", (key, chat_id, hostname, auth_token, json.dumps(payload), now, now))
+        return cursor.lastrowid
+
+    def due(self, limit=50, shard=None):
+        """Entries to deliver now, only those of the chats of `shard`, (index, count), if given"""
+        if shard is None:
+            return self._entries("SELECT * FROM outbox WHERE status = ? AND next_attempt <= ? ORDER BY id LIMIT ?",
+                                 (PENDING, time.time(), limit))
+        index, count = shard
+        # same rule as shard.shard_of
+        return self._entries("SELECT * FROM outbox WHERE status = ? AND next_attempt <= ? AND abs(chat_id) % ? = ? "
+                             "ORDER BY id LIMIT ?", (PENDING, time.time(), count, index, limit))
+
+    def pending(self, chat_id):
+        return self._entries("SELECT * FROM outbox WHERE status = ? AND chat_id = ? ORDER BY id", (PENDING, chat_id))
+
+    def mark_delivered(self, entry_id, tx_id):
+        self._update("UPDATE outbox SET status = ?, tx_id = ?, attempts = attempts + 1 WHERE id = ?",
+                     (DELIVERED, tx_id, entry_id))
+
+    def mark_failed(self, entry_id, error):
+        self._update("UPDATE outbox SET status = ?, last_error = ?, attempts = attempts + 1 WHERE id = ?",
+                     (FAILED, error, entry_id))
+
+    def reschedule(self, entry, error):
+        delay = min(BACKOFF_BASE * 2 ** entry.attempts, BACKOFF_MAX) * random.uniform(0.5, 1.0)
+        self._update("UPDATE outbox SET attempts = attempts + 1, next_attempt = ?, last_error = ? WHERE id = ?",
+                     (time.time() + delay, error, entry.id))
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class OutboxWorker(threading.Thread):
+    """
+    Drains the outbox in the background. `notify(chat_id, text)` is called once an
+    entry has been delivered or has finally failed.
+    """
+
+    def __init__(self, outbox, notify, cache=None, mirror=None, poll_interval=5, shard=None):
+        super().__init__(name="firefly-outbox", daemon=True)
+        self.outbox = outbox
+        self.notify = notify
+        self.cache = cache
+        self.mirror = mirror
+        self.poll_interval = poll_interval
+        self.shard = shard
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+
+    def wake(self):
+        self._wake.set()
+
+    def stop(self):
+        self._stopped.set()
+        self._wake.set()
+        self.join()
+
+    def run(self):
+        while not self._stopped.is_set():
+            try:
+                entries = self.outbox.due(shard=self.shard)
+            except Exception:
+                logger.exception("Reading the outbox failed")
+                entries = []
+            for entry in entries:
+                if self._stopped.is_set():
+                    break
+                # one bad entry must not stop the delivery of the others
+                try:
+                    self.deliver(entry)
+                except Exception:
+                    logger.exception("Delivery of outbox entry %s failed", entry.id)
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+
+    def deliver(self, entry):
+        firefly = Firefly(hostname=entry.hostname, auth_token=entry.auth_token, cache=self.cache,
+                          mirror=self.mirror)
+        description = entry.payload["transactions"][0].get("description")
+        try:
+            response = firefly.create_transaction_group(entry.payload)
+        except requests.RequestException as e:
+            self._retry(entry, str(e))
+            return
+
+        if response.status_code == 200:
+            try:
+                tx_id = response.json()["data"]["id"]
+            except (ValueError, KeyError, TypeError):
+                self._retry(entry, "HTTP 200 without a transaction in the body")
+                return
+            self.outbox.mark_delivered(entry.id, tx_id)
+            self._notify(entry.chat_id, f"Expense '{description}' logged successfully. "
+                                       f"Use /list {tx_id} to see details.")
+        elif response.status_code == 422 and DUPLICATE.search(response.text):
+            # an earlier attempt went through but its response got lost
+            tx_id = DUPLICATE.search(response.text).group(1)
+            self.outbox.mark_delivered(entry.id, tx_id)
+            self._notify(entry.chat_id, f"Expense '{description}' logged successfully. "
+                                       f"Use /list {tx_id} to see details.")
+        elif response.status_code == 429 or response.status_code >= 500:
+            self._retry(entry, f"HTTP {response.status_code}")
+        else:
+            error = response.text[:500]
+            self.outbox.mark_failed(entry.id, error)
+            self._notify(entry.chat_id, f"Expense '{description}' was rejected by Firefly "
+                                       f"({response.status_code}), please check the input values.")
+
+    def _retry(self, entry, error):
+        logger.warning("Delivery of outbox entry %s failed: %s", entry.id, error)
+        if entry.attempts + 1 >= MAX_ATTEMPTS:
+            self.outbox.mark_failed(entry.id, error)
+            description = entry.payload["transactions"][0].get("description")
+            self._notify(entry.chat_id, f"Giving up on expense '{description}' after {MAX_ATTEMPTS} attempts: {error}")
+        else:
+            self.outbox.reschedule(entry, error)
+
+    def _notify(self, chat_id, text):
+        # best effort, a user who blocked the bot must not hold up the outbox
+        try:
+            self.notify(chat_id, text)
+        except Exception:
+            logger.exception("Notifying chat %s failed", chat_id)
@@ -0,0 +1,157 @@
+"""
+SQLite backed persistence for the dispatcher.
+
+Unlike PicklePersistence, which rewrites the whole state file, every user, chat and
+conversation is its own row. Only records whose content changed are written, and
+user and chat data are loaded from the database the first time they are accessed.
+"""
+import hashlib
+import json
+import pickle
+import sqlite3
+import sys
+import threading
+from collections import defaultdict
+from pathlib import Path
+
+from telegram.ext import BasePersistence
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS user_data (id INTEGER PRIMARY KEY, data BLOB NOT NULL);
+CREATE TABLE IF NOT EXISTS chat_data (id INTEGER PRIMARY KEY, data BLOB NOT NULL);
+CREATE TABLE IF NOT EXISTS bot_data (id INTEGER PRIMARY KEY CHECK (id = 0), data BLOB NOT NULL);
+CREATE TABLE IF NOT EXISTS conversations (
+    name TEXT NOT NULL,
+    key TEXT NOT NULL,
+    state BLOB NOT NULL,
+    PRIMARY KEY (name, key)
+);
+CREATE TABLE IF NOT EXISTS activity (id INTEGER PRIMARY KEY, seen INTEGER NOT NULL);
+CREATE INDEX IF NOT EXISTS activity_seen ON activity (seen);
+"""
+
+
+def _digest(blob):
+    return hashlib.blake2b(blob, digest_size=16).digest()
+
+
+class LazyDataDict(defaultdict):
+    """defaultdict that looks up missing keys in the database before creating them"""
+
+    def __init__(self, load):
+        super().__init__(dict)
+        self._load = load
+
+    def __missing__(self, key):
+        value = self._load(key)
+        self[key] = value
+        return value
+
+
+class SQLitePersistence(BasePersistence):
+    def __init__(self, filename, store_user_data=True, store_chat_data=True, store_bot_data=True):
+        super().__init__(store_user_data=store_user_data, store_chat_data=store_chat_data,
+                         store_bot_data=store_bot_data)
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(filename), check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(SCHEMA)
+        # digests of what is stored, to skip writing records that did not change
+        self._written = {}
+
+    def _load(self, table, record_id):
+        with self._lock:
+            row = self._db.execute(f"SELECT data FROM {table} WHERE id = ?", (record_id,)).fetchone()
+        if row is None:
+            return {}
+        self._written[(table, record_id)] = _digest(row[0])
+        return pickle.loads(row[0])
+
+    def _store(self, table, record_id, data):
+        blob = pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+        digest = _digest(blob)
+        if self._written.get((table, record_id)) == digest:
+            return
+        with self._lock:
+            self._db.execute(f"INSERT OR REPLACE INTO {table} (id, data) VALUES (?, ?)", (record_id, blob))
+        self._written[(table, record_id)] = digest
+
+    def get_user_data(self):
+        return LazyDataDict(lambda user_id: self._load("user_data", user_id))
+
+    def get_chat_data(self):
+        return LazyDataDict(lambda chat_id: self._load("chat_data", chat_id))
+
+    def get_bot_data(self):
+        return self._load("bot_data", 0)
+
+    def get_conversations(self, name):
+        with self._lock:
+            rows = self._db.execute("SELECT key, state FROM conversations WHERE name = ?", (name,)).fetchall()
+        return {tuple(json.loads(key)): pickle.loads(state) for key, state in rows}
+
+    def update_conversation(self, name, key, new_state):
+        with self._lock:
+            if new_state is None:
+                self._db.execute("DELETE FROM conversations WHERE name = ? AND key = ?", (name, json.dumps(key)))
+            else:
+                self._db.execute("INSERT OR REPLACE INTO conversations (name, key, state) VALUES (?, ?, ?)",
+                                 (name, json.dumps(key), pickle.dumps(new_state)))
+
+    def update_user_data(self, user_id, data):
+        self._store("user_data", user_id, data)
+
+    def update_chat_data(self, chat_id, data):
+        self._store("chat_data", chat_id, data)
+
+    def update_bot_data(self, data):
+        self._store("bot_data", 0, data)
+
+    def touch_user(self, user_id, seen):
+        """Remember when a user was last seen, a unix timestamp"""
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO activity (id, seen) VALUES (?, ?)", (user_id, int(seen)))
+
+    def active_users(self, since):
+        """Ids of the users seen at or after `since`, most recent first"""
+        with self._lock:
+            rows = self._db.execute("SELECT id FROM activity WHERE seen >= ? ORDER BY seen DESC",
+                                    (int(since),)).fetchall()
+        return [row[0] for row in rows]
+
+    def flush(self):
+        with self._lock:
+            self._db.execute("PRAGMA wal_checkpoint(PASSIVE)")
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def migrate_pickle(pickle_file, filename):
+    """Copy the state of a single file PicklePersistence into a SQLite database"""
+    with open(pickle_file, "rb") as f:
+        data = pickle.load(f)
+    persistence = SQLitePersistence(filename)
+    persistence._db.execute("BEGIN")
+    for user_id, user_data in data.get("user_data", {}).items():
+        persistence.update_user_data(user_id, user_data)
+    for chat_id, chat_data in data.get("chat_data", {}).items():
+        persistence.update_chat_data(chat_id, chat_data)
+    if data.get("bot_data"):
+        persistence.update_bot_data(data["bot_data"])
+    for name, conversations in (data.get("conversations") or {}).items():
+        for key, state in conversations.items():
+            persistence.update_conversation(name, key, state)
+    persistence._db.execute("COMMIT")
+    persistence.close()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        sys.exit("usage: python persistence.py <pickle file> <sqlite file>")
+    if Path(sys.argv[2]).exists():
+        sys.exit(f"{sys.argv[2]} already exists")
+    migrate_pickle(sys.argv[1], sys.argv[2])
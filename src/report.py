@@ -0,0 +1,131 @@
+"""
+Spending reports over a range of months.
+
+The withdrawals of a month are summed up per currency, in total and by category,
+budget and destination, in a single pass. Closed months are stored with the
+transaction mirror and only computed again after their transactions changed, the
+current month is always computed from the mirror.
+"""
+import datetime
+from decimal import Decimal
+
+from mirror import month_bounds
+
+DIMENSIONS = ("category", "budget", "destination")
+NONE = "(none)"
+MAX_MONTHS = 36
+
+
+class ReportError(Exception):
+    pass
+
+
+def parse_months(args, today=None):
+    """`/report [YYYY-MM [YYYY-MM]]`, the current month by default. Returns the first and last month"""
+    today = today or datetime.date.today()
+    months = []
+    for arg in args[:2]:
+        try:
+            months.append(datetime.datetime.strptime(arg, "%Y-%m").strftime("%Y-%m"))
+        except ValueError:
+            raise ReportError(f"{arg} is not a month, use the form YYYY-MM")
+    current = today.strftime("%Y-%m")
+    first = months[0] if months else current
+    last = months[1] if len(months) > 1 else (first if months else current)
+    if first > last:
+        first, last = last, first
+    if last > current:
+        raise ReportError("The report can't go beyond the current month")
+    if len(month_range(first, last)) > MAX_MONTHS:
+        raise ReportError(f"A report covers at most {MAX_MONTHS} months")
+    return first, last
+
+
+def month_range(first, last):
+    months = []
+    year, number = int(first[:4]), int(first[5:7])
+    while True:
+        month = f"{year}-{number:02}"
+        if month > last:
+            return months
+        months.append(month)
+        year, number = (year + 1, 1) if number == 12 else (year, number + 1)
+
+
+def aggregate(transactions):
+    """Totals of withdrawals by currency: total, count and amounts per category, budget and destination"""
+    totals = {}
+    for tx in transactions:
+        for split in tx.splits:
+            if split.type != "withdrawal" or split.amount is None:
+                continue
+            currency = totals.get(split.currency_code)
+            if currency is None:
+                currency = totals[split.currency_code] = dict(total=Decimal(0), count=0,
+                                                              **{name: {} for name in DIMENSIONS})
+            amount = split.amount
+            currency["total"] += amount
+            currency["count"] += 1
+            for amounts, key in ((currency["category"], split.category_name),
+                                 (currency["budget"], split.budget_name),
+                                 (currency["destination"], split.destination_name)):
+                key = key or NONE
+                amounts[key] = amounts.get(key, 0) + amount
+    return totals
+
+
+def encode(totals):
+    return {currency: dict(total=str(values["total"]), count=values["count"],
+                           **{name: {key: str(amount) for key, amount in values[name].items()}
+                              for name in DIMENSIONS})
+            for currency, values in totals.items()}
+
+
+def decode(data):
+    return {currency: dict(total=Decimal(values["total"]), count=values["count"],
+                           **{name: {key: Decimal(amount) for key, amount in values[name].items()}
+                              for name in DIMENSIONS})
+            for currency, values in data.items()}
+
+
+def merge(months):
+    totals = {}
+    for month in months:
+        for currency, values in month.items():
+            merged = totals.setdefault(currency, dict(total=Decimal(0), count=0, **{name: {} for name in DIMENSIONS}))
+            merged["total"] += values["total"]
+            merged["count"] += values["count"]
+            for name in DIMENSIONS:
+                for key, amount in values[name].items():
+                    merged[name][key] = merged[name].get(key, 0) + amount
+    return totals
+
+
+def build_report(mirror, key, first, last, today=None):
+    """Merged totals of the months `first` to `last`, YYYY-MM"""
+    current = (today or datetime.date.today()).strftime("%Y-%m")
+    months = []
+    for month in month_range(first, last):
+        if month < current:
+            months.append(decode(mirror.month_totals(key, month, lambda txs: encode(aggregate(txs)))))
+        else:
+            start, end = month_bounds(month)
+            months.append(aggregate(mirror.between(key, start, end)))
+    return merge(months)
+
+
+def format_report(totals, first, last, limit=10):
+    period = first if first == last else f"{first} to {last}"
+    if not totals:
+        return f"No expenses in {period}"
+    lines = [f"Expenses in {period}"]
+    for currency, values in sorted(totals.items(), key=lambda item: str(item[0])):
+        lines.append("")
+        lines.append(f"{currency} {values['total']} in {values['count']} expenses")
+        for name in DIMENSIONS:
+            amounts = sorted(values[name].items(), key=lambda item: (-item[1], item[0]))
+            lines.append(f"By {name}:")
+            lines.extend(f"  {key}: {amount}" for key, amount in amounts[:limit])
+            if len(amounts) > limit:
+                lines.append(f"  {len(amounts) - limit} more: {sum(amount for _, amount in amounts[limit:])}")
+    return "\n".join(lines)
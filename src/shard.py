@@ -0,0 +1,142 @@
+"""
+Running the bot as several processes.
+
+One front end process receives the updates, by polling or through the webhook, and
+hands each one to the worker process that owns its user. A user always lands on the
+same worker, so conversation states, button tokens and lanes need no sharing between
+processes, and every worker keeps its own Firefly sessions and caches. The workers
+share the SQLite files, rows belonging to a user are only written by its worker.
+"""
+import logging
+import multiprocessing
+import signal
+import threading
+import time
+from queue import Full
+
+from telegram import Update
+from telegram.ext import Dispatcher, JobQueue
+
+from dispatch import lane_key
+
+logger = logging.getLogger(__name__)
+
+
+def shard_of(key, shards):
+    """Worker owning a user or chat id, the same rule is used in SQL to pick outbox entries"""
+    return abs(int(key)) % shards
+
+
+class ShardRouter(Dispatcher):
+    """
+    Dispatcher of the front end, passes every update on to the queue of its worker.
+    While that queue is full the router waits, so its own update queue fills up and
+    the webhook listener pushes back, see UpdateQueue.
+    """
+
+    def __init__(self, bot, update_queue, worker_pool):
+        # the Updater insists on a job queue, jobs run in the workers
+        super().__init__(bot, update_queue, workers=0, use_context=True, job_queue=JobQueue())
+        self.job_queue.set_dispatcher(self)
+        self.worker_pool = worker_pool
+        self.routed = [0] * len(worker_pool.queues)
+        self.dropped = 0
+
+    def process_update(self, update):
+        if not isinstance(update, Update):
+            super().process_update(update)
+            return
+        key = lane_key(update)
+        shard = shard_of(key, len(self.worker_pool.queues)) if key is not None else 0
+        queue, process = self.worker_pool.queues[shard], self.worker_pool.processes[shard]
+        data = update.to_dict()
+        while True:
+            # nobody reads the queue of a worker that died, waiting for room would hang the router
+            if not process.is_alive():
+                logger.error("Worker %s is not running, dropping update %s", process.name, update.update_id)
+                self.dropped += 1
+                return
+            try:
+                queue.put(data, timeout=1)
+                break
+            except Full:
+                pass
+        self.routed[shard] += 1
+
+    def stats(self):
+        stats = {f"shard_{index}": routed for index, routed in enumerate(self.routed)}
+        stats["dropped"] = self.dropped
+        return stats
+
+
+class Workers(object):
+    """
+    Starts `count` processes running `target(index, count, queue)`, where `queue`
+    yields the update dicts routed to the worker and None once it should stop. With
+    `maxsize`, at most that many updates wait in the queue of each worker.
+    """
+
+    def __init__(self, target, count, maxsize=0):
+        context = multiprocessing.get_context("spawn")
+        self.queues = [context.Queue(maxsize) for _ in range(count)]
+        self.processes = [context.Process(target=target, args=(index, count, queue), name=f"bot-worker-{index}")
+                          for index, queue in enumerate(self.queues)]
+        self._stopping = threading.Event()
+
+    def start(self):
+        for process in self.processes:
+            process.start()
+
+    def watch(self, on_exit, interval=1.0):
+        """Call `on_exit(process)` from a background thread when a worker ends before `stop`"""
+        def run():
+            while not self._stopping.wait(interval):
+                for process in self.processes:
+                    if not process.is_alive():
+                        on_exit(process)
+                        return
+        threading.Thread(target=run, name="worker-watch", daemon=True).start()
+
+    def stop(self, timeout=30):
+        self._stopping.set()
+        for queue, process in zip(self.queues, self.processes):
+            if process.is_alive():
+                try:
+                    queue.put(None, timeout=timeout)
+                except Full:
+                    pass
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                logger.warning("Worker %s did not stop in time", process.name)
+                process.terminate()
+
+
+def feed(updater, queue):
+    """
+    Run the dispatcher of a worker process on the updates of `queue` until the front
+    end sends None. Signals are left to the front end, it stops the workers in order.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    dispatcher = updater.dispatcher
+    updater.job_queue.start()
+    thread = threading.Thread(target=dispatcher.start, name="dispatcher")
+    thread.start()
+    while True:
+        data = queue.get()
+        if data is None:
+            break
+        update = Update.de_json(data, updater.bot)
+        while True:
+            # a bounded UpdateQueue gives up after a while, the worker has to wait for room instead
+            try:
+                dispatcher.update_queue.put(update)
+                break
+            except Full:
+                pass
+    while not dispatcher.update_queue.empty():
+        time.sleep(0.05)
+    updater.job_queue.stop()
+    dispatcher.stop()
+    thread.join()
@@ -0,0 +1,125 @@
+"""
+Protection for Firefly instances against bursts of requests.
+
+`SingleFlight` lets concurrent callers asking for the same thing share one call.
+`HostLimiter` keeps a token bucket per hostname. A host answering 429 or 5xx gets
+its rate halved, and a Retry-After header is honoured. Every success afterwards
+raises the rate back a step at a time.
+"""
+import threading
+import time
+
+MIN_RATE = 0.5
+RECOVERY_STEP = 0.1
+
+
+class _Call(object):
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """Runs `fn` once per key at a time, callers arriving meanwhile get the same result"""
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        """Returns (result, shared), `shared` is True for callers that waited on another one"""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+        try:
+            call.result = fn()
+            return call.result, False
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+
+class _Bucket(object):
+    __slots__ = ("rate", "tokens", "updated", "blocked_until")
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+
+class HostLimiter(object):
+    """
+    Token buckets per host, `rate` requests per second with bursts of up to `burst`.
+    A rate of None turns limiting off.
+    """
+
+    def __init__(self, rate=None, burst=10):
+        self.rate = rate
+        self.burst = burst
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def configure(self, rate, burst):
+        with self._lock:
+            self.rate = rate
+            self.burst = burst
+            self._buckets.clear()
+
+    def reserve(self, host):
+        """Take a token and return how many seconds to wait before sending the request"""
+        if self.rate is None:
+            return 0.0
+        with self._lock:
+            bucket = self._buckets.get(host)
+            if bucket is None:
+                bucket = self._buckets[host] = _Bucket(self.rate, self.burst)
+            now = time.monotonic()
+            bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.updated) * bucket.rate)
+            bucket.updated = now
+            bucket.tokens -= 1
+            delay = max(0.0, -bucket.tokens / bucket.rate)
+            return max(delay, bucket.blocked_until - now)
+
+    def feedback(self, host, status, retry_after=None):
+        if self.rate is None:
+            return
+        with self._lock:
+            bucket = self._buckets.get(host)
+            if bucket is None:
+                return
+            # "error" stands for a request that got no response at all
+            if status in (429, "error") or (isinstance(status, int) and status >= 500):
+                bucket.rate = max(MIN_RATE, bucket.rate / 2)
+                if retry_after:
+                    bucket.blocked_until = max(bucket.blocked_until, time.monotonic() + retry_after)
+            elif bucket.rate < self.rate:
+                bucket.rate = min(self.rate, bucket.rate + self.rate * RECOVERY_STEP)
+
+    def stats(self):
+        with self._lock:
+            return {host: bucket.rate for host, bucket in self._buckets.items()}
+
+
+def retry_after(headers):
+    """Seconds from a Retry-After header, only the delay form is understood"""
+    value = headers.get("Retry-After")
+    try:
+        return min(float(value), 300.0) if value else None
+    except ValueError:
+        return None
@@ -0,0 +1,29 @@
+"""
+Short opaque tokens for the callback data of inline keyboard buttons.
+
+Telegram allows at most 64 bytes of callback data, so the payload of a button stays
+on the server and the button only carries a token pointing at it. Tokens expire and
+the least recently used ones are dropped once the registry is full, a pressed button
+whose token is gone resolves to None.
+"""
+import secrets
+
+from cache import TTLCache
+
+TOKEN_BYTES = 8
+
+
+class CallbackTokens(object):
+    def __init__(self, maxsize=10000, ttl=24 * 3600):
+        self._payloads = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    def register(self, payload):
+        token = secrets.token_urlsafe(TOKEN_BYTES)
+        self._payloads.set(token, payload)
+        return token
+
+    def resolve(self, token):
+        return self._payloads.get(token)
+
+    def stats(self):
+        return self._payloads.stats()
@@ -0,0 +1,115 @@
+"""
+Name search over a user's expense accounts for inline queries.
+
+Names starting with the typed text come first, found by bisecting a sorted list.
+The rest of the results are ranked by trigram similarity, so typos and words in
+the middle of a name are found too. When the account list changes the index is
+patched with the difference, not rebuilt.
+"""
+import threading
+from bisect import bisect_left
+from collections import Counter
+
+from cache import TTLCache
+
+
+def trigrams(text):
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class AccountIndex(object):
+    def __init__(self, accounts=()):
+        self.source = None
+        self._accounts = {}
+        self._names = []
+        self._trigrams = {}
+        self._sizes = {}
+        self._lock = threading.Lock()
+        self.update(accounts)
+
+    def _add(self, account):
+        name = account.name.lower()
+        self._accounts[account.id] = account
+        self._names.append((name, account.id))
+        grams = trigrams(name)
+        self._sizes[account.id] = len(grams)
+        for gram in grams:
+            self._trigrams.setdefault(gram, set()).add(account.id)
+
+    def _remove(self, account):
+        name = account.name.lower()
+        del self._accounts[account.id]
+        del self._sizes[account.id]
+        del self._names[bisect_left(self._names, (name, account.id))]
+        for gram in trigrams(name):
+            postings = self._trigrams[gram]
+            postings.discard(account.id)
+            if not postings:
+                del self._trigrams[gram]
+
+    def update(self, accounts):
+        """Make the index match `accounts`, touching only added, renamed and removed ones"""
+        current = {account.id: account for account in accounts if account.active}
+        with self._lock:
+            for account_id, account in list(self._accounts.items()):
+                new = current.get(account_id)
+                if new is None or new.name != account.name:
+                    self._remove(account)
+            added = False
+            for account_id, account in current.items():
+                if account_id not in self._accounts:
+                    self._add(account)
+                    added = True
+                else:
+                    self._accounts[account_id] = account
+            if added:
+                # appended names are sorted in once, timsort takes advantage of the sorted head
+                self._names.sort()
+            self.source = accounts
+
+    def search(self, text, limit=20):
+        text = text.strip().lower()
+        with self._lock:
+            if not text:
+                return [self._accounts[account_id] for _, account_id in self._names[:limit]]
+
+            found = []
+            position = bisect_left(self._names, (text,))
+            while position < len(self._names) and len(found) < limit:
+                name, account_id = self._names[position]
+                if not name.startswith(text):
+                    break
+                found.append(account_id)
+                position += 1
+
+            if len(found) < limit:
+                grams = trigrams(text)
+                shared = Counter()
+                for gram in grams:
+                    shared.update(self._trigrams.get(gram, ()))
+                prefixed = set(found)
+                scored = []
+                for account_id, count in shared.items():
+                    if account_id in prefixed:
+                        continue
+                    similarity = count / (len(grams) + self._sizes[account_id] - count)
+                    if similarity >= 0.2 or count == len(grams):
+                        scored.append((-similarity, self._accounts[account_id].name.lower(), account_id))
+                scored.sort()
+                found.extend(account_id for _, _, account_id in scored[:limit - len(found)])
+            return [self._accounts[account_id] for account_id in found]
+
+
+# indexes per Firefly login, patched whenever the cached account list is reloaded
+_indexes = TTLCache(maxsize=256, ttl=24 * 3600)
+
+
+def get_account_index(user_key, accounts):
+    index = _indexes.get(user_key)
+    if index is None:
+        index = AccountIndex(accounts)
+        _indexes.set(user_key, index)
+    elif index.source is not accounts:
+        index.update(accounts)
+    return index
@@ -0,0 +1,113 @@
+"""
+Background warm-up of the reference data of recently active users.
+
+Every `interval` seconds the users seen within the last `active_window` seconds are
+looked up. A background thread hands a share of them to their lanes every `TICK`
+seconds, so the round is spread over the interval and Firefly sees a steady trickle
+instead of a burst. The loading runs in the user's lane, in order with the user's
+updates. The job queue is not used: PTB saves the persistence of every loaded user
+after each job run. Users that haven't been around for a while are left alone.
+"""
+import logging
+import math
+import threading
+import time
+from collections import deque
+
+from shard import shard_of
+
+logger = logging.getLogger(__name__)
+
+# last seen times are written at most this often per user
+TOUCH_INTERVAL = 60
+# warm-ups are handed to the lanes in batches this often
+TICK = 5
+
+
+class Warmup(object):
+    def __init__(self, persistence, load, interval=240, active_window=7 * 24 * 3600, shard=None):
+        """
+        `load(user_data)` fetches what a user's first command needs. With `shard`, (index, count),
+        only the users of that worker process are warmed up.
+        """
+        self.persistence = persistence
+        self.load = load
+        self.shard = shard
+        self.interval = interval
+        self.active_window = active_window
+        self.scheduled = 0
+        self.warmed = 0
+        self.failed = 0
+        self._touched = {}
+        self._round = deque()
+        self._batch = 0
+        self._next_round = 0
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def touch(self, update, context):
+        """Handler for every update, records that its user is active"""
+        user = update.effective_user
+        if user is None:
+            return
+        now = time.time()
+        if now - self._touched.get(user.id, 0) >= TOUCH_INTERVAL:
+            self._touched[user.id] = now
+            self.persistence.touch_user(user.id, now)
+
+    def start(self, dispatcher):
+        self._thread = threading.Thread(target=self._run, args=(dispatcher,), name="warmup", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self, dispatcher):
+        while True:
+            try:
+                self.tick(dispatcher)
+            except Exception:
+                logger.exception("Warm-up failed")
+            if self._stopped.wait(min(TICK, self.interval)):
+                return
+
+    def active_users(self):
+        users = self.persistence.active_users(time.time() - self.active_window)
+        if self.shard is not None:
+            index, count = self.shard
+            users = [user_id for user_id in users if shard_of(user_id, count) == index]
+        return users
+
+    def tick(self, dispatcher):
+        now = time.time()
+        if now >= self._next_round:
+            self._next_round = now + self.interval
+            self._round = deque(self.active_users())
+            # enough per tick to get through the round within the interval
+            self._batch = math.ceil(len(self._round) * min(TICK, self.interval) / self.interval)
+            self.scheduled += len(self._round)
+        for _ in range(min(self._batch, len(self._round))):
+            self.warm_user(dispatcher, self._round.popleft())
+
+    def warm_user(self, dispatcher, user_id):
+        # the user data is looked up in the lane, where the user's updates touch it too
+        dispatcher.lanes.submit(user_id, lambda: self._load(user_id, dispatcher.user_data))
+
+    def _load(self, user_id, users_data):
+        user_data = users_data[user_id]
+        if not user_data.get("firefly_url") or not user_data.get("firefly_token"):
+            return
+        try:
+            self.load(user_data)
+            self.warmed += 1
+        except Exception as e:
+            self.failed += 1
+            logger.warning("Warming up user %s failed: %s", user_id, e)
+
+    def stats(self, reset=False):
+        stats = dict(scheduled=self.scheduled, warmed=self.warmed, failed=self.failed)
+        if reset:
+            self.scheduled = self.warmed = self.failed = 0
+        return stats